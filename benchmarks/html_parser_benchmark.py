@@ -0,0 +1,109 @@
+# Compares the chunked HTML tokenizer against the old character-at-a-time parser.
+# Run from the repository root: python benchmarks/html_parser_benchmark.py
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parser import HTMLParser, Element
+
+class CharacterParser(HTMLParser):
+    # the parse loop HTMLParser used before the chunked tokenizer
+    def parse(self):
+        text = ""
+        in_tag = False
+        in_comment = False
+        in_script = False
+        in_double_quote_attribute = False
+        in_single_quote_attribute = False
+        for c in self.body:
+            in_attribute = in_single_quote_attribute or in_double_quote_attribute
+            if c == "<" and not in_comment and not in_attribute:
+                in_tag = True
+                if text and not in_script: self.add_text(text)
+                text = ""
+            elif c == ">" and not in_comment and not in_attribute:
+                in_tag = False
+                if text == "p" and "p" in [node.tag for node in self.unfinished]:
+                    self.add_tag("/p")
+                if text == "script":
+                    in_script = True
+                if not in_script: self.add_tag(text)
+                elif text == "/script":
+                    in_script = False
+                text = ""
+            else:
+                text += c
+                if in_tag and text == "!--":
+                    in_comment = True
+                if in_comment and text.endswith("-->"):
+                    in_comment = False
+                    in_tag = False
+                    text = ""
+                if in_tag:
+                    if not in_double_quote_attribute and text.endswith("=\""):
+                        in_double_quote_attribute = True
+                    elif in_double_quote_attribute and text.endswith("\"") and not text.endswith("\\\""):
+                        in_double_quote_attribute = False
+                    if not in_single_quote_attribute and text.endswith("='"):
+                        in_single_quote_attribute = True
+                    elif in_single_quote_attribute and text.endswith("'") and not text.endswith("\\'"):
+                        in_single_quote_attribute = False
+        if not in_tag and text and not in_script:
+            self.add_text(text)
+        return self.finish()
+
+LOREM = "Lorem ipsum dolor sit amet, consetetur sadipscing elitr, sed diam nonumy eirmod tempor. "
+
+def generate_document(paragraphs, words_per_paragraph):
+    out = "<!doctype html><html><head><title>Report</title>"
+    out += "<link rel=stylesheet href=\"/report.css\"></head><body>"
+    text = (LOREM * (words_per_paragraph // 12 + 1))
+    for i in range(paragraphs):
+        out += "<!-- section {} -->".format(i)
+        out += "<div class=\"section item-{}\" id='s{}'>".format(i % 7, i)
+        out += "<h2>Section {}</h2><p>{}</p>".format(i, text)
+        out += "<p><a href=\"/detail?id={}\">details</a> <b>bold</b> <i>italic</i></p>".format(i)
+        out += "</div>"
+    out += "</body></html>"
+    return out
+
+def generate_long_text(length):
+    # a single huge text run is the worst case for the old parser
+    return "<html><body><pre>" + ("x" * 79 + "\n") * (length // 80) + "</pre></body></html>"
+
+def count_nodes(node):
+    return 1 + sum(count_nodes(child) for child in node.children)
+
+def dump(node):
+    if isinstance(node, Element):
+        return (node.tag, node.attributes, [dump(child) for child in node.children])
+    return node.text
+
+def measure(parser_class, body):
+    start = time.perf_counter()
+    tree = parser_class(body).parse()
+    return time.perf_counter() - start, tree
+
+def measure_chunked(body, chunk_size):
+    start = time.perf_counter()
+    parser = HTMLParser()
+    for i in range(0, len(body), chunk_size):
+        parser.feed(body[i:i + chunk_size])
+    tree = parser.close()
+    return time.perf_counter() - start, tree
+
+def run(name, body):
+    old_time, old_tree = measure(CharacterParser, body)
+    new_time, new_tree = measure(HTMLParser, body)
+    chunked_time, chunked_tree = measure_chunked(body, 16 * 1024)
+    assert dump(old_tree) == dump(new_tree) == dump(chunked_tree), "parsers disagree on " + name
+    print("{:<28} {:>8.2f} MB {:>8} nodes   old {:>8.0f}ms   new {:>7.0f}ms   chunked {:>7.0f}ms   speedup {:>5.1f}x".format(
+        name, len(body) / 1e6, count_nodes(new_tree), old_time * 1000, new_time * 1000,
+        chunked_time * 1000, old_time / new_time))
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(10000)
+    run("report, 1k sections", generate_document(1000, 100))
+    run("report, 5k sections", generate_document(5000, 100))
+    run("long text run, 1MB", generate_long_text(1000000))
+    run("long text run, 4MB", generate_long_text(4000000))
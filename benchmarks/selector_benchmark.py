@@ -0,0 +1,48 @@
+# Compares parsing a selector and matching it with the selector objects against
+# the cached parsed selectors and their compiled match functions.
+# Run from the repository root: python benchmarks/selector_benchmark.py
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parser import HTMLParser
+from helpers import tree_to_list
+from style import CSSParser, parse_selector, matcher
+
+SELECTORS = ["div", ".item-3", "p.lead", "div.section.item-2", "div p", ".section p a", "body div .item-4 b"]
+
+def generate_document(sections):
+    out = "<html><body>"
+    for i in range(sections):
+        out += "<div class=\"section item-{}\" id='s{}'>".format(i % 7, i)
+        out += "<h2>Section {}</h2><p class=\"lead\">Intro</p>".format(i)
+        out += "<p><a href=\"/detail?id={}\">details</a> <b>bold</b> <i>italic</i></p>".format(i)
+        out += "</div>"
+    out += "</body></html>"
+    return out
+
+def measure(nodes, repeat, select):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [select(text, nodes) for text in SELECTORS]
+    return time.perf_counter() - start, results
+
+def select_parsed(text, nodes):
+    selector = CSSParser(text).selector()
+    return [node for node in nodes if selector.matches(node)]
+
+def select_compiled(text, nodes):
+    match = matcher(parse_selector(text))
+    return [node for node in nodes if match(node)]
+
+def run(name, sections, repeat):
+    nodes = tree_to_list(HTMLParser(generate_document(sections)).parse(), [])
+    old_time, old_results = measure(nodes, repeat, select_parsed)
+    new_time, new_results = measure(nodes, repeat, select_compiled)
+    assert old_results == new_results, "selectors disagree on " + name
+    print("{:<24} {:>7} nodes   objects {:>7.0f}ms   compiled {:>7.0f}ms   speedup {:>5.1f}x".format(
+        name, len(nodes), old_time * 1000, new_time * 1000, old_time / new_time))
+
+if __name__ == "__main__":
+    run("100 sections x100", 100, 100)
+    run("2k sections x10", 2000, 10)
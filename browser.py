@@ -1,11 +1,13 @@
 import sys
+import os
 from helpers import resolve_url, tree_to_list, url_origin
 from layout.inline_layout import get_font, visited_urls, InputLayout
-from request import request
+from layout.fonts import measure_text, FONT_MANAGER
+from request import request, request_async
 from parser import HTMLParser, ViewSourceParser, print_tree, Element, Text
 from layout.document_layout import DocumentLayout
-from constants import CHROME_PX, SCROLL_STEP, HEIGHT, WIDTH, INTEREST_REGION_SIZE, REFRESH_RATE_SEC
-from style import CSSParser, style, cascade_priority
+from constants import CHROME_PX, SCROLL_STEP, HEIGHT, WIDTH, INTEREST_REGION_SIZE, REFRESH_RATE_SEC, PROGRESSIVE_RENDER_INTERVAL_SEC
+from style import parse_style_sheet, style, RuleIndex
 import urllib.parse
 import dukpy
 from js_context import JSContext
@@ -16,9 +18,13 @@ from layout.skia_helpers import draw_rect, draw_line, draw_text, parse_color
 import layout.skia_helpers
 import ctypes
 from layout.drawing import scrolldown_element, scrollup_element
-from taskrunner import TaskRunner, Task
+from taskrunner import TaskRunner, Task, SCRIPT_PRIORITY, RENDERING_PRIORITY
+from tiles import TileCache, tile_rect
+from timers import TimerQueue
+from chrome import ChromePiece, ChromeCache
 import threading
 import time
+import cache
 
 def handle_special_pages(url, browser):
     if url == "about:bookmarks":
@@ -60,13 +66,15 @@ class MeasureTime:
 class Tab:
     def __init__(self, browser):
         with open("browser.css") as f:
-            self.default_style_sheet = CSSParser(f.read()).parse()
+            self.default_style_sheet = parse_style_sheet(f.read())
         self.history = []
         self.future = []
         self.url = ""
         self.browser = browser
         self.rules = None
+        self.rule_index = None
         self.nodes = None
+        self.dom_index = None
         self.focus = None
         self.document = None
         self.is_secure_connection = False
@@ -74,14 +82,17 @@ class Tab:
         self.interest_region = [0, 0]
         self.task_runner = TaskRunner()
         self.task_runner.start()
+        self.timers = TimerQueue()
+        self.js = None
         self.needs_render = False
         self.measure_render = MeasureTime("render")
         self.scroll = 0
         self.scroll_changed_in_tab = False
+        self.last_progress_render = 0
     
-    def run_script(self, url, body):
+    def run_script(self, js, url, body):
         try:
-            print("Script returned: ", self.js.run(body))
+            print("Script returned: ", js.run(body))
         except dukpy.JSRuntimeError as e:
             print("Script", url, "crashed", e)
 
@@ -94,14 +105,30 @@ class Tab:
             self.url = url
             self.scroll_to_fragment(url)
         else:
+            # the previous page's scripts and timers stop before any part of
+            # the new document is rendered
+            self.timers.clear()
+            if self.js:
+                self.js.discard()
+                self.js = None
+            self.interest_region = [0, 0]
+            parser = HTMLParser()
             headers, body, view_source = handle_special_pages(url, self.browser)
-            if not body:
+            if body:
+                parser.feed(body)
+            else:
+                self.last_progress_render = time.time()
+                on_data = lambda data: self.receive_data(url, parser, data)
                 headers, body, view_source = request(url, self.url, payload=req_body, 
-                    referrer_policy=self.referrer_policy, send_referrer=send_referrer)
+                    referrer_policy=self.referrer_policy, send_referrer=send_referrer, on_data=on_data)
             if view_source:
-                self.nodes = ViewSourceParser(body).parse()
+                parser = ViewSourceParser(body)
+                self.nodes = parser.parse()
             else:
-                self.nodes = HTMLParser(body).parse()
+                self.nodes = parser.close()
+            self.dom_index = parser.index
+            # the progressive frames computed an interest region for a shorter document
+            self.interest_region = [0, 0]
             self.is_secure_connection = "https" in url and not body.startswith("SSL Error:")
             # print_tree(self.nodes)
             self.referrer_policy = headers["referrer-policy"] if "referrer-policy" in headers else None
@@ -113,45 +140,73 @@ class Tab:
             scripts = [node.attributes["src"] for node in tree_to_list(self.nodes, [])
                        if isinstance(node, Element) and node.tag == "script"
                        and "src" in node.attributes]
-            self.js = JSContext(self)
+            links = [node.attributes["href"] for node in tree_to_list(self.nodes, [])
+                    if isinstance(node, Element) and node.tag == "link" and "href" in node.attributes
+                    and node.attributes.get("rel") == "stylesheet"]
+            # start all downloads at once, but consume the results in document order
+            script_downloads = []
             for script in scripts:
                 script_url = resolve_url(script, url)
                 if not self.allowed_request(script_url):
                     print("Blocked script", script, "due to CSP")
                     continue
-                header, body, _ = request(script_url, url, referrer_policy=self.referrer_policy)
-                task = Task(self.run_script, script_url, body)
-                self.task_runner.schedule_task(task)
-                # try:
-                #     self.js.run(body)
-                # except dukpy.JSRuntimeError as e:
-                #     print("Script", script, "crashed", e)
-            self.rules = self.default_style_sheet.copy()
-            links = [node.attributes["href"] for node in tree_to_list(self.nodes, [])
-                    if isinstance(node, Element) and node.tag == "link" and "href" in node.attributes
-                    and node.attributes.get("rel") == "stylesheet"]
+                script_downloads.append((script_url, request_async(script_url, url, referrer_policy=self.referrer_policy)))
+            link_downloads = []
             for link in links:
                 try:
                     link_url = resolve_url(link, url)
                     if not self.allowed_request(link_url):
                         print("Blocked link", link_url, "due to CSP")
                         continue
-                    header, body, _ = request(link_url, url, referrer_policy=self.referrer_policy)
+                    link_downloads.append((link, request_async(link_url, url, referrer_policy=self.referrer_policy)))
+                except:
+                    print("error downloading stylesheet {}".format(link))
+            self.js = JSContext(self)
+            for script_url, download in script_downloads:
+                header, body, _ = download.result()
+                task = Task(self.run_script, self.js, script_url, body)
+                self.task_runner.schedule_task(task, SCRIPT_PRIORITY)
+                # try:
+                #     self.js.run(body)
+                # except dukpy.JSRuntimeError as e:
+                #     print("Script", script, "crashed", e)
+            self.rules = list(self.default_style_sheet)
+            for link, download in link_downloads:
+                try:
+                    header, body, _ = download.result()
                     print("downloaded stylesheet {}".format(link))
                 except:
                     print("error downloading stylesheet {}".format(link))
                     continue
-                self.rules.extend(CSSParser(body).parse())
+                self.rules.extend(parse_style_sheet(body))
             inline_styles = [node for node in tree_to_list(self.nodes, []) if isinstance(node, Element) and node.tag == "style"]
             for node in inline_styles:
                 if node.children:
-                    self.rules.extend(CSSParser(node.children[0].text).parse())
+                    self.rules.extend(parse_style_sheet(node.children[0].text))
             self.set_needs_render()
             self.scroll = 0
             self.scroll_changed_in_tab = True
             self.url = url
             self.scroll_to_fragment(url)
     
+    def receive_data(self, url, parser, data):
+        parser.feed(data)
+        now = time.time()
+        if now - self.last_progress_render < PROGRESSIVE_RENDER_INTERVAL_SEC:
+            return
+        if not parser.root(): return
+        self.last_progress_render = now
+        # paint what has been parsed so far with the default style sheet,
+        # scripts and linked style sheets are handled once the body is complete
+        self.url = url
+        self.nodes = parser.root()
+        self.rules = self.default_style_sheet
+        self.scroll = 0
+        self.scroll_changed_in_tab = True
+        self.needs_render = True
+        self.render()
+        self.commit_frame()
+
     def render(self):
         if not self.needs_render:
             # print("[tab] render (skipping)", self.url)
@@ -159,8 +214,14 @@ class Tab:
         print("[tab] render ", self.url)
         self.measure_render.start()
         self.needs_render = False
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
-        self.document = DocumentLayout(self.nodes)
+        rules_changed = not self.rule_index or not self.rule_index.indexes(self.rules)
+        if rules_changed:
+            self.rule_index = RuleIndex(self.rules)
+        style(self.nodes, self.rule_index, force=rules_changed)
+        # the layout tree is kept between renders so that only the parts
+        # whose nodes changed are laid out again
+        if not self.document or self.document.node is not self.nodes:
+            self.document = DocumentLayout(self.nodes)
         self.document.layout()
         self.display_list = []
         self.document.paint(self.display_list)
@@ -173,8 +234,12 @@ class Tab:
         if not self.scroll_changed_in_tab:
             self.scroll = scroll
         # print("run_animation_frame scroll:", scroll, " self.scroll:", self.scroll)
-        self.js.interp.evaljs("__runRAFHandlers()")
+        if self.js:
+            self.js.run("__runRAFHandlers()")
         self.render()
+        self.commit_frame()
+
+    def commit_frame(self):
         document_height = self.document.height
         clamped_scroll = clamp_scroll(self.scroll, document_height)
         if clamped_scroll != self.scroll:
@@ -246,7 +311,7 @@ class Tab:
             if isinstance(elt, Text):
                 pass
             else:
-                do_default, stop_propagation = self.js.dispatch_event("click", elt)
+                do_default, stop_propagation = self.dispatch_event("click", elt)
                 if do_default:
                     if elt.tag == "a" and "href" in elt.attributes:
                         unresolved_url = elt.attributes["href"]
@@ -276,6 +341,12 @@ class Tab:
                     return
             elt = elt.parent
     
+    def dispatch_event(self, type, elt):
+        # while a page loads it has no scripts yet to handle the event
+        if not self.js:
+            return True, False
+        return self.js.dispatch_event(type, elt)
+
     def submit_form_by_enter(self):
         if not self.focus:
             return
@@ -286,7 +357,7 @@ class Tab:
             elt = elt.parent
 
     def submit_form(self, elt):
-        do_default, _ = self.js.dispatch_event("submit", elt)
+        do_default, _ = self.dispatch_event("submit", elt)
         if not do_default: return
         inputs = [node for node in tree_to_list(elt, []) if isinstance(node, Element)
                   and node.tag == "input" and "name" in node.attributes]
@@ -313,7 +384,7 @@ class Tab:
     def keypress(self, char):
         if self.focus:
             if self.focus.tag == "input" and self.focus.attributes.get("type", "") != "checkbox":
-                do_default, _ = self.js.dispatch_event("keydown", self.focus)
+                do_default, _ = self.dispatch_event("keydown", self.focus)
                 if not do_default: return
                 self.focus.attributes["value"] += char
                 self.set_needs_render()
@@ -373,7 +444,7 @@ class Tab:
             type = self.focus.attributes.get("type", "")
             if type != "checkbox":
                 text = self.focus.attributes.get("value", "")
-                x = obj.x + obj.font.measureText(text)
+                x = obj.x + measure_text(obj.font, text)
                 y = obj.y
                 # self.display_list.append(DrawLine(x, y, x, y + obj.height))
                 draw_line(canvas, x, y, x, y + obj.height, width=2)
@@ -397,19 +468,6 @@ class Tab:
         self.scroll = scroll
         self.scroll_changed_in_tab = True
 
-def raster(canvas, display_list, interest_region, scale):
-    # if not self.document: return
-    canvas.save()
-    canvas.clipRect(skia.Rect.MakeLTRB(0, 0, WIDTH * scale, INTEREST_REGION_SIZE * browser.scale))
-    # print("raster - translation: ", -interest_region[0] * scale)
-    # print("interest region", interest_region)
-    canvas.translate(0, -interest_region[0] * scale)
-    for cmd in display_list:
-        cmd.execute(canvas)
-    # if self.focus:
-    #     self.draw_input_focus(canvas)
-    canvas.restore()
-
 def clamp_scroll(scroll, tab_height):
     return max(0, min(scroll, tab_height - (HEIGHT - CHROME_PX)))
 
@@ -434,24 +492,24 @@ class Browser:
         # if res < 0:
         #     # out = ctypes.c_char_p
             # print(sdl2.SDL_GetError())
-        self.root_surface = skia.Surface.MakeRaster(
+        # the root surface draws into pixels we own, so that damaged parts of
+        # them can be copied into the window texture without a snapshot
+        self.root_pitch = 4 * self.scale * WIDTH
+        self.root_pixels = (ctypes.c_uint8 * (self.root_pitch * self.scale * HEIGHT))()
+        self.root_surface = skia.Surface.MakeRasterDirect(
             skia.ImageInfo.Make(
                 self.scale * WIDTH, self.scale * HEIGHT,
                 ct=skia.kRGBA_8888_ColorType,
                 at=skia.kUnpremul_AlphaType
-            ))
+            ), self.root_pixels, self.root_pitch)
+        self.texture = sdl2.SDL_CreateTexture(self.renderer, sdl2.SDL_PIXELFORMAT_RGBA32,
+            sdl2.SDL_TEXTUREACCESS_STREAMING, self.scale * WIDTH, self.scale * HEIGHT)
+        # the part of the window that changed since the last draw, in device pixels
+        self.damage = skia.Rect.MakeWH(self.scale * WIDTH, self.scale * HEIGHT)
+        self.drawn_tab_state = None
         self.chrome_surface = skia.Surface(self.scale * WIDTH, self.scale * CHROME_PX)
-        self.tab_surface = None
-        if sdl2.SDL_BYTEORDER == sdl2.SDL_BIG_ENDIAN:
-            self.RED_MASK = 0xff000000
-            self.GREEN_MASK = 0x00ff0000
-            self.BLUE_MASK = 0x0000ff00
-            self.ALPHA_MASK = 0x000000ff
-        else:
-            self.RED_MASK = 0x000000ff
-            self.GREEN_MASK = 0x0000ff00
-            self.BLUE_MASK = 0x00ff0000
-            self.ALPHA_MASK = 0xff000000
+        self.chrome_cache = ChromeCache(self.scale, self.chrome_surface)
+        self.tile_cache = TileCache(self.scale, self.tile_ready)
         self.width = WIDTH
         self.height = HEIGHT
         self.zoom_factor = 1
@@ -515,82 +573,157 @@ class Browser:
         active_tab.task_runner.schedule_task(task)
         self.lock.release()
     
+    def visible_tab_region(self):
+        # the part of the page in the viewport, in page coordinates
+        top = self.active_tab_interest_region[0] + self.scroll
+        return top, top + HEIGHT - CHROME_PX
+
     def raster_tab(self):
-        if not self.tab_surface:
-            self.tab_surface = skia.Surface(self.scale * WIDTH, self.scale * INTEREST_REGION_SIZE)
-        canvas = self.tab_surface.getCanvas()
-        canvas.clear(skia.ColorWHITE)
-        # draw page content
-        raster(
-            canvas, 
-            self.active_tab_display_list, 
-            self.active_tab_interest_region,
-            self.scale
-        )
-        # self.tabs[self.active_tab].draw(canvas)
+        if not self.active_tab_interest_region:
+            return
+        if self.tile_cache.display_list is not self.active_tab_display_list:
+            self.tile_cache.set_display_list(self.active_tab_display_list)
+        self.tile_cache.retain(*self.active_tab_interest_region)
+        self.tile_cache.raster(*self.visible_tab_region(), *self.active_tab_interest_region)
+
+    def add_damage(self, rect):
+        self.damage.join(rect)
+
+    def tab_rect(self):
+        return skia.Rect.MakeLTRB(0, self.scale * CHROME_PX, self.scale * WIDTH, self.scale * HEIGHT)
+
+    def damage_tab(self):
+        # scrolling, a new interest region or switching tabs move everything
+        # in the tab, otherwise only tiles rastered since the last draw changed
+        damaged_tiles = self.tile_cache.take_damage()
+        tab_rect = self.tab_rect()
+        if not self.active_tab_interest_region:
+            state = (self.active_tab, None)
+        else:
+            state = (self.active_tab, self.visible_tab_region(), tuple(self.active_tab_interest_region))
+        if state != self.drawn_tab_state:
+            self.drawn_tab_state = state
+            self.add_damage(tab_rect)
+            return
+        if not self.active_tab_interest_region:
+            return
+        top, _ = state[1]
+        for key in damaged_tiles:
+            rect = tile_rect(key).makeOffset(0, CHROME_PX - top)
+            rect = skia.Rect.MakeLTRB(self.scale * rect.left(), self.scale * rect.top(),
+                self.scale * rect.right(), self.scale * rect.bottom())
+            if rect.intersect(tab_rect):
+                self.add_damage(rect)
+
+    def tile_ready(self):
+        # called on a raster worker when a tile finished
+        self.lock.acquire(blocking=True)
+        self.set_needs_raster_and_draw()
+        self.lock.release()
     
-    def raster_chrome(self):
-        # print("raster chrome")
-        canvas = self.chrome_surface.getCanvas()
-        canvas.clear(skia.ColorWHITE)
-        # draw tabs
+    def chrome_pieces(self):
+        tab = self.tabs[self.active_tab]
+        pieces = [ChromePiece("frame", skia.Rect.MakeLTRB(0, 0, WIDTH, CHROME_PX), (), self.paint_chrome_frame)]
+        for i in range(len(self.tabs)):
+            x1, x2 = 40 + 80 * i, 120 + 80 * i
+            pieces.append(ChromePiece(("tab", i), skia.Rect.MakeLTRB(x1 - 1, 0, x2 + 1, 41), "Tab {}".format(i),
+                lambda canvas, i=i: self.paint_tab_label(canvas, i)))
+        x1, x2 = 40 + 80 * self.active_tab, 120 + 80 * self.active_tab
+        pieces.append(ChromePiece("active tab", skia.Rect.MakeLTRB(0, 39, WIDTH, 42), (x1, x2),
+            lambda canvas: self.paint_active_tab(canvas, x1, x2)))
+        pieces.append(ChromePiece("new tab", skia.Rect.MakeLTRB(9, 0, 39, 41), (), self.paint_new_tab_button))
+        if self.focus == "address bar":
+            address_bar_state = (self.address_bar, self.text_cursor_position)
+        else:
+            address_bar_state = self.url
+        pieces.append(ChromePiece("address bar", skia.Rect.MakeLTRB(69, 49, WIDTH - 59, 91),
+            (self.focus == "address bar", address_bar_state), self.paint_address_bar))
+        back_color = "black" if len(tab.history) > 1 else "gray"
+        pieces.append(ChromePiece("back", skia.Rect.MakeLTRB(9, 49, 36, 91), back_color,
+            lambda canvas: self.paint_back_button(canvas, back_color)))
+        forward_color = "black" if len(tab.future) > 0 else "gray"
+        pieces.append(ChromePiece("forward", skia.Rect.MakeLTRB(39, 49, 66, 91), forward_color,
+            lambda canvas: self.paint_forward_button(canvas, forward_color)))
+        bookmark_bgcolor = "yellow" if tab.url in self.bookmarks else "white"
+        pieces.append(ChromePiece("bookmark", skia.Rect.MakeLTRB(WIDTH - 51, 49, WIDTH - 9, 91), bookmark_bgcolor,
+            lambda canvas: self.paint_bookmark_button(canvas, bookmark_bgcolor)))
+        return pieces
+
+    def paint_chrome_frame(self, canvas):
         draw_rect(canvas, -1, 0, WIDTH, CHROME_PX, fill="white")
         draw_rect(canvas, -1, 0, WIDTH, CHROME_PX - 1)
-        tabfont = skia.Font(skia.Typeface('Arial'), 20)
-        for i, tab in enumerate(self.tabs):
-            name = "Tab {}".format(i)
-            x1, x2 = 40 + 80 * i, 120 + 80 * i
-            draw_line(canvas, x1, 0, x1, 40)
-            draw_line(canvas, x2, 0, x2, 40)
-            draw_text(canvas, x1 + 10, 10, name, tabfont)
-            if i == self.active_tab:
-                draw_line(canvas, 0, 40, x1, 40)
-                draw_line(canvas, x2, 40, WIDTH, 40)
-            buttonfont = skia.Font(skia.Typeface('Arial'), 30)
-            draw_rect(canvas, 10, 10, 30, 30)
-            draw_text(canvas, 11, 4, "+", buttonfont)
-        # draw address bar
+
+    def paint_tab_label(self, canvas, i):
+        tabfont = get_font(20, "normal", "roman")
+        x1, x2 = 40 + 80 * i, 120 + 80 * i
+        draw_line(canvas, x1, 0, x1, 40)
+        draw_line(canvas, x2, 0, x2, 40)
+        draw_text(canvas, x1 + 10, 10, "Tab {}".format(i), tabfont)
+
+    def paint_active_tab(self, canvas, x1, x2):
+        draw_line(canvas, 0, 40, x1, 40)
+        draw_line(canvas, x2, 40, WIDTH, 40)
+
+    def paint_new_tab_button(self, canvas):
+        buttonfont = get_font(30, "normal", "roman")
+        draw_rect(canvas, 10, 10, 30, 30)
+        draw_text(canvas, 11, 4, "+", buttonfont)
+
+    def paint_address_bar(self, canvas):
+        buttonfont = get_font(30, "normal", "roman")
         draw_rect(canvas, 70, 50, WIDTH - 60, 90)
         if self.focus == "address bar":
             draw_text(canvas, 85, 55, self.address_bar, buttonfont)
-            w = buttonfont.measureText(self.address_bar[:self.text_cursor_position])
+            w = measure_text(buttonfont, self.address_bar[:self.text_cursor_position])
             draw_line(canvas, 85 + w, 55, 85 + w, 85, width=2)
         else:
             if self.url:
                 draw_text(canvas, 85, 55, self.url, font=buttonfont)
-        # draw back button
-        back_color = "black" if len(self.tabs[self.active_tab].history) > 1 else "gray"
+
+    def paint_back_button(self, canvas, color):
         draw_rect(canvas, 10, 50, 35, 90)
         path = skia.Path().moveTo(self.scale * 15, self.scale * 70).lineTo(self.scale * 30, self.scale * 55).lineTo(self.scale * 30, self.scale * 85)
-        paint = skia.Paint(Color=parse_color(back_color), Style=skia.Paint.kFill_Style)
+        paint = skia.Paint(Color=parse_color(color), Style=skia.Paint.kFill_Style)
         canvas.drawPath(path, paint)
-        # draw forward button
-        forward_color = "black" if len(self.tabs[self.active_tab].future) > 0 else "gray"
+
+    def paint_forward_button(self, canvas, color):
         draw_rect(canvas, 40, 50, 65, 90)
         path = skia.Path().moveTo(self.scale * 45, self.scale * 55).lineTo(self.scale * 60, self.scale * 70).lineTo(self.scale * 45, self.scale * 85)
-        paint = skia.Paint(Color=parse_color(forward_color), Style=skia.Paint.kFill_Style)
+        paint = skia.Paint(Color=parse_color(color), Style=skia.Paint.kFill_Style)
         canvas.drawPath(path, paint)
-        # bookmark button
-        bookmarkfont = skia.Font(skia.Typeface('Arial'), 12)
-        bookmark_bgcolor = "yellow" if self.tabs[self.active_tab].url in self.bookmarks else "white"
+
+    def paint_bookmark_button(self, canvas, bgcolor):
+        bookmarkfont = get_font(12, "normal", "roman")
         draw_rect(canvas, WIDTH - 50, 50, WIDTH - 10, 90)
-        draw_rect(canvas, WIDTH - 49, 51, WIDTH - 11, 89, fill=bookmark_bgcolor, width=10)
+        draw_rect(canvas, WIDTH - 49, 51, WIDTH - 11, 89, fill=bgcolor, width=10)
         draw_text(canvas, WIDTH - 44, 55, "book", bookmarkfont)
         draw_text(canvas, WIDTH - 44, 70, "mark", bookmarkfont)
+
+    def raster_chrome(self):
+        # only pieces of the chrome whose state changed are rastered again
+        self.add_damage(self.chrome_cache.update(self.chrome_pieces()))
     
     def draw(self):
+        damage = self.damage.roundOut()
+        if not damage.intersect(skia.IRect.MakeWH(self.scale * WIDTH, self.scale * HEIGHT)):
+            return
+        self.damage = skia.Rect.MakeEmpty()
         canvas = self.root_surface.getCanvas()
+        canvas.save()
+        canvas.clipRect(skia.Rect.Make(damage))
         canvas.clear(skia.ColorWHITE)
 
         # draw tab
-        tab_rect = skia.Rect.MakeLTRB(0, self.scale * CHROME_PX, self.scale * WIDTH, self.scale * HEIGHT)
-        tab_offset = self.scale * (CHROME_PX - self.scroll)
-        # print("drawing offset with scroll: ", self.scroll)
-        canvas.save()
-        canvas.clipRect(tab_rect)
-        canvas.translate(0, tab_offset)
-        self.tab_surface.draw(canvas, 0, 0)
-        canvas.restore()
+        if self.active_tab_interest_region:
+            tab_rect = skia.Rect.MakeLTRB(0, self.scale * CHROME_PX, self.scale * WIDTH, self.scale * HEIGHT)
+            top, bottom = self.visible_tab_region()
+            tab_offset = self.scale * (CHROME_PX - top)
+            # print("drawing offset with scroll: ", self.scroll)
+            canvas.save()
+            canvas.clipRect(tab_rect)
+            canvas.translate(0, tab_offset)
+            self.tile_cache.draw(canvas, top, bottom)
+            canvas.restore()
 
         # draw chrome
         chrome_rect = skia.Rect.MakeLTRB(0, 0, self.scale * WIDTH, self.scale * CHROME_PX)
@@ -599,24 +732,18 @@ class Browser:
         self.chrome_surface.draw(canvas, 0, 0)
         canvas.restore()
 
-        skia_image = self.root_surface.makeImageSnapshot()
-        # skia_image = skia_image.resize(WIDTH, HEIGHT, filterQuality=skia.FilterQuality.kHigh_FilterQuality)
-        skia_bytes = skia_image.tobytes()
-        depth = 32
-        pitch = 4 * self.scale * WIDTH
-        sdl_surface = sdl2.SDL_CreateRGBSurfaceFrom(
-            skia_bytes, self.scale * WIDTH, self.scale * HEIGHT, depth, pitch, self.RED_MASK, 
-            self.GREEN_MASK, self.BLUE_MASK, self.ALPHA_MASK)
-        # scaled = sdl2.sdlgfx.zoomSurface(sdl_surface, 0.5, 0.5, 1)
-        # rect = sdl2.SDL_Rect(0, 0, WIDTH, HEIGHT)
-        # dest_rect = sdl2.SDL_Rect(0, 0, WIDTH, HEIGHT)
-        # window_surface = sdl2.SDL_GetWindowSurface(self.sdl_window)
-        # sdl2.SDL_BlitSurface(sdl_surface, rect, window_surface, rect)
-        texture = sdl2.SDL_CreateTextureFromSurface(self.renderer, sdl_surface)
+        canvas.restore()
+        self.present(damage)
+
+    def present(self, rect):
+        # copies the damaged rect of the root surface into the window texture
+        offset = rect.top() * self.root_pitch + 4 * rect.left()
+        pixels = ctypes.c_void_p(ctypes.addressof(self.root_pixels) + offset)
+        sdl_rect = sdl2.SDL_Rect(rect.left(), rect.top(), rect.width(), rect.height())
+        sdl2.SDL_UpdateTexture(self.texture, sdl_rect, pixels, self.root_pitch)
         sdl2.SDL_RenderClear(self.renderer)
-        sdl2.SDL_RenderCopy(self.renderer, texture, None, None)
+        sdl2.SDL_RenderCopy(self.renderer, self.texture, None, None)
         sdl2.SDL_RenderPresent(self.renderer)
-        # sdl2.SDL_UpdateWindowSurface(self.sdl_window)
     
     def scrolldown(self):
         max_y = max(0, self.active_tab_height - (self.height - CHROME_PX))
@@ -780,21 +907,30 @@ class Browser:
     
     def raster_and_draw(self):
         self.lock.acquire(blocking=True)
-        if not self.needs_raster_and_draw:
+        try:
+            if not self.needs_raster_and_draw:
+                return
+            # print("[browser] raster_and_draw")
+            self.measure_raster_and_draw.start()
+            self.raster_chrome()
+            self.raster_tab()
+            self.damage_tab()
+            self.draw()
+            self.needs_raster_and_draw = False
+            self.measure_raster_and_draw.stop()
+            FONT_MANAGER.end_frame()
+        finally:
             self.lock.release()
-            return
-        # print("[browser] raster_and_draw")
-        self.measure_raster_and_draw.start()
-        self.raster_chrome()
-        self.raster_tab()
-        self.draw()
-        self.needs_raster_and_draw = False
-        self.measure_raster_and_draw.stop()
-        self.lock.release()
     
     def handle_quit(self):
         # self.tabs[self.active_tab].handle_quit()
         print(self.measure_raster_and_draw.text())
+        print(FONT_MANAGER.text())
+        print(self.tile_cache.text())
+        print(self.chrome_cache.text())
+        print(self.tabs[self.active_tab].task_runner.text())
+        print(cache.cache.text())
+        cache.close()
         sdl2.SDL_DestroyWindow(self.sdl_window)
     
     def schedule_animation_frame(self):
@@ -804,7 +940,7 @@ class Browser:
             active_tab = self.tabs[self.active_tab]
             self.needs_animation_frame = False
             task = Task(active_tab.run_animation_frame, scroll)
-            active_tab.task_runner.schedule_task(task)
+            active_tab.task_runner.schedule_task(task, RENDERING_PRIORITY)
             self.animation_timer = None
             self.lock.release()
         self.lock.acquire(blocking=True)
@@ -816,6 +952,9 @@ class Browser:
 if __name__ == "__main__":
     import sys
     sdl2.SDL_Init(sdl2.SDL_INIT_EVENTS)
+    cache_dir = os.environ.get("TOY_BROWSER_CACHE_DIR")
+    if cache_dir:
+        cache.enable_disk_cache(cache_dir)
     browser = Browser()
     url = sys.argv[1] if len(sys.argv) >= 2 else "file://test.html"
     browser.load(url)
@@ -1,30 +1,266 @@
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from helpers import datetime_from_http_date
+from disk_cache import DiskCache
 
-cache = {}
+MAX_CACHE_SIZE_BYTES = 32 * 1024 * 1024
+# fraction of the time since Last-Modified a response is considered fresh
+# if the server didn't send an explicit lifetime (RFC 7234, section 4.2.2)
+HEURISTIC_FRESHNESS_FRACTION = 0.1
 
-def try_to_cache(url, headers, body):
-    if not "cache-control" in headers:
-        return
-    cache_control = headers["cache-control"]
-    if cache_control.startswith("max-age"):
-        max_age_value = cache_control[len("max-age="):]
-        if not max_age_value.isnumeric():
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip().lower()
+        if not directive:
+            continue
+        if "=" in directive:
+            name, arg = directive.split("=", 1)
+            directives[name.strip()] = arg.strip().strip("\"")
+        else:
+            directives[directive] = None
+    return directives
+
+def parse_seconds(value):
+    if value is None or not value.isnumeric():
+        return None
+    return int(value)
+
+def parse_http_date(value):
+    if not value:
+        return None
+    date = datetime_from_http_date(value)
+    if date and not date.tzinfo:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+def wall_clock(monotonic_time):
+    # the disk tier outlives the process, so it can't store monotonic timestamps
+    return time.time() + (monotonic_time - time.monotonic())
+
+def monotonic_clock(wall_clock_time):
+    return time.monotonic() + (wall_clock_time - time.time())
+
+class CacheEntry:
+    def __init__(self, headers, body, size):
+        self.headers = headers
+        self.body = body
+        self.size = size
+        self.fresh_until = 0
+        self.etag = None
+        self.last_modified = None
+
+    def is_fresh(self, now):
+        return now < self.fresh_until
+
+    def has_validators(self):
+        return self.etag is not None or self.last_modified is not None
+
+class HTTPCache:
+    def __init__(self, max_size=MAX_CACHE_SIZE_BYTES, shared=False):
+        # a browser cache is a private cache, shared=True gives proxy semantics
+        # (honor s-maxage and don't store private responses)
+        self.max_size = max_size
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.disk = None
+
+    def enable_disk_cache(self, directory, max_size=None):
+        if max_size is None:
+            self.disk = DiskCache(directory)
+        else:
+            self.disk = DiskCache(directory, max_size)
+
+    def freshness_lifetime(self, headers, directives):
+        if "no-cache" in directives:
+            return 0
+        if self.shared and parse_seconds(directives.get("s-maxage")) is not None:
+            return parse_seconds(directives["s-maxage"])
+        if parse_seconds(directives.get("max-age")) is not None:
+            return parse_seconds(directives["max-age"])
+        date = parse_http_date(headers.get("date")) or datetime.now(timezone.utc)
+        if "expires" in headers:
+            expires = parse_http_date(headers["expires"])
+            if not expires:
+                # invalid dates like "0" mean already expired
+                return 0
+            return max(0, (expires - date).total_seconds())
+        last_modified = parse_http_date(headers.get("last-modified"))
+        if last_modified:
+            return max(0, (date - last_modified).total_seconds() * HEURISTIC_FRESHNESS_FRACTION)
+        return 0
+
+    def initial_age(self, headers):
+        age = parse_seconds(headers.get("age")) or 0
+        date = parse_http_date(headers.get("date"))
+        if date:
+            apparent_age = (datetime.now(timezone.utc) - date).total_seconds()
+            age = max(age, apparent_age)
+        return age
+
+    def is_storable(self, headers, directives):
+        if "no-store" in directives:
+            return False
+        if self.shared and "private" in directives:
+            return False
+        if headers.get("vary", "").strip() == "*":
+            return False
+        return True
+
+    def update_freshness(self, entry):
+        directives = parse_cache_control(entry.headers.get("cache-control", ""))
+        lifetime = self.freshness_lifetime(entry.headers, directives)
+        entry.fresh_until = time.monotonic() + lifetime - self.initial_age(entry.headers)
+        entry.etag = entry.headers.get("etag")
+        entry.last_modified = entry.headers.get("last-modified")
+
+    def store(self, url, headers, body):
+        directives = parse_cache_control(headers.get("cache-control", ""))
+        entry = CacheEntry(headers, body, len(body.encode("utf8")))
+        self.update_freshness(entry)
+        # entries that are neither fresh nor revalidatable are useless, but
+        # they still replace whatever was stored for the url before
+        if not self.is_storable(headers, directives) or \
+                (not entry.is_fresh(time.monotonic()) and not entry.has_validators()):
+            with self.lock:
+                self.remove(url)
+            if self.disk:
+                self.disk.delete(url)
             return
-        max_age = int(max_age_value)
-        age = 0
-        if "age" in headers:
-            age = int(headers["age"])
-        now_timestamp = int(datetime.timestamp(datetime.now()))
-        cache[url] = {
-            "response": (headers, body),
-            "fresh_until": now_timestamp + max_age - age,
-        }
+        with self.lock:
+            self.remove(url)
+            if entry.size > self.max_size:
+                return
+            self.entries[url] = entry
+            self.size += entry.size
+            self.evict()
+        if self.disk:
+            self.disk.store(url, headers, body, wall_clock(entry.fresh_until))
+
+    def remove(self, url):
+        entry = self.entries.pop(url, None)
+        if entry:
+            self.size -= entry.size
+
+    def evict(self):
+        while self.size > self.max_size:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def get_entry(self, url):
+        # memory misses fall back to the disk tier, entries found there are
+        # moved into memory whether they are still fresh or need revalidation
+        entry = self.entries.get(url)
+        if entry or not self.disk:
+            return entry
+        stored = self.disk.load(url)
+        if not stored:
+            return None
+        headers, body, expires_at = stored
+        entry = CacheEntry(headers, body, len(body.encode("utf8")))
+        entry.fresh_until = monotonic_clock(expires_at)
+        entry.etag = headers.get("etag")
+        entry.last_modified = headers.get("last-modified")
+        if entry.size > self.max_size:
+            return entry
+        self.entries[url] = entry
+        self.size += entry.size
+        self.evict()
+        return entry
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.get_entry(url)
+            if entry and entry.is_fresh(time.monotonic()):
+                if url in self.entries:
+                    self.entries.move_to_end(url)
+                self.hits += 1
+                return entry.headers, entry.body
+            self.misses += 1
+            return None
+
+    def conditional_headers(self, url):
+        with self.lock:
+            entry = self.get_entry(url)
+            if not entry:
+                return {}
+            headers = {}
+            if entry.etag is not None:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified is not None:
+                headers["If-Modified-Since"] = entry.last_modified
+            return headers
+
+    def revalidated(self, url, headers):
+        # a 304 response refreshes the stored headers and freshness of an entry
+        with self.lock:
+            entry = self.get_entry(url)
+            if not entry:
+                return None
+            for header, value in headers.items():
+                if header in ["content-length", "content-encoding", "transfer-encoding"]:
+                    continue
+                entry.headers[header] = value
+            self.update_freshness(entry)
+            if url in self.entries:
+                self.entries.move_to_end(url)
+            self.revalidations += 1
+            if self.disk:
+                self.disk.update(url, entry.headers, wall_clock(entry.fresh_until))
+            return entry.headers, entry.body
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+        if self.disk:
+            self.disk.clear()
+
+    def close(self):
+        if self.disk:
+            self.disk.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "size": self.size,
+            }
+
+    def text(self):
+        stats = self.stats()
+        return "Cache: {} hits, {} misses, {} revalidations, {} evictions, {} entries ({} bytes)".format(
+            stats["hits"], stats["misses"], stats["revalidations"], stats["evictions"], stats["entries"], stats["size"])
+
+cache = HTTPCache()
+
+def enable_disk_cache(directory, max_size=None):
+    cache.enable_disk_cache(directory, max_size)
+
+def close():
+    cache.close()
+
+def try_to_cache(url, headers, body):
+    cache.store(url, headers, body)
 
 def get_cached_response(url):
-    if url in cache:
-        cached = cache[url]
-        now_timestamp = int(datetime.timestamp(datetime.now()))
-        fresh_until = cached["fresh_until"]
-        if now_timestamp <= fresh_until:
-            response = cached["response"]
-            return response[0], response[1]
\ No newline at end of file
+    return cache.lookup(url)
+
+def conditional_headers(url):
+    return cache.conditional_headers(url)
+
+def revalidated_response(url, headers):
+    return cache.revalidated(url, headers)
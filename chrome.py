@@ -0,0 +1,80 @@
+import math
+import skia
+from layout.drawing import ltrb
+
+def device_rect(rect, scale):
+    return skia.Rect.MakeLTRB(
+        math.floor(rect.left() * scale), math.floor(rect.top() * scale),
+        math.ceil(rect.right() * scale), math.ceil(rect.bottom() * scale))
+
+class ChromePiece:
+    # a part of the browser chrome, rect is in chrome coordinates and state is
+    # everything the piece is drawn from. paint draws it in chrome coordinates,
+    # anything outside of rect is clipped
+    def __init__(self, key, rect, state, paint):
+        self.key = key
+        self.rect = rect
+        self.state = state
+        self.paint = paint
+
+class ChromeCache:
+    # every piece is rastered into its own image, which is kept until the
+    # state or rect of the piece changes. the chrome surface is composited
+    # from the images again only where a piece changed
+    def __init__(self, scale, surface):
+        self.scale = scale
+        self.surface = surface
+        self.images = {}
+        self.drawn = {}
+        self.rastered = 0
+        self.reused = 0
+
+    def image(self, piece):
+        version = (ltrb(piece.rect), piece.state)
+        cached = self.images.get(piece.key)
+        if cached and cached[0] == version:
+            self.reused += 1
+            return cached[1]
+        rect = device_rect(piece.rect, self.scale)
+        surface = skia.Surface(int(rect.width()), int(rect.height()))
+        canvas = surface.getCanvas()
+        canvas.clear(skia.ColorTRANSPARENT)
+        canvas.translate(-rect.left(), -rect.top())
+        piece.paint(canvas)
+        image = surface.makeImageSnapshot()
+        self.images[piece.key] = (version, image)
+        self.rastered += 1
+        return image
+
+    def update(self, pieces):
+        # returns the part of the chrome surface that changed, in device pixels
+        damage = skia.Rect.MakeEmpty()
+        drawn = {}
+        for piece in pieces:
+            version = (ltrb(piece.rect), piece.state)
+            drawn[piece.key] = version
+            previous = self.drawn.get(piece.key)
+            if previous != version:
+                damage.join(device_rect(piece.rect, self.scale))
+                if previous:
+                    damage.join(device_rect(skia.Rect.MakeLTRB(*previous[0]), self.scale))
+        for key, previous in self.drawn.items():
+            if key not in drawn:
+                damage.join(device_rect(skia.Rect.MakeLTRB(*previous[0]), self.scale))
+                self.images.pop(key, None)
+        self.drawn = drawn
+        if damage.isEmpty():
+            return damage
+        canvas = self.surface.getCanvas()
+        canvas.save()
+        canvas.clipRect(damage)
+        canvas.clear(skia.ColorWHITE)
+        for piece in pieces:
+            rect = device_rect(piece.rect, self.scale)
+            if skia.Rect.Intersects(rect, damage):
+                canvas.drawImage(self.image(piece), rect.left(), rect.top())
+        canvas.restore()
+        return damage
+
+    def text(self):
+        return "Chrome: {} pieces rastered, {} reused".format(self.rastered, self.reused)
@@ -0,0 +1,223 @@
+import math
+import threading
+import skia
+from collections import OrderedDict
+import layout.skia_helpers
+from layout.drawing import SaveLayer, Transform, ClipRRect, reorder_by_z_index, join_bounds
+
+# budget for cached layer images, in device pixels
+MAX_LAYER_CACHE_PIXELS = 32 * 1024 * 1024
+# larger layers are rastered into the tiles like everything else
+MAX_LAYER_PIXELS = 4 * 1024 * 1024
+
+class LayerParts:
+    # the SaveLayer -> Transform -> ClipRRect chain paint_visual_effects
+    # wraps around the commands of a node. opacity, blend mode, transform and
+    # scroll only change how the layer is composited, the rest of it is
+    # rastered once into an image
+    def __init__(self, cmd):
+        self.save_layer = None
+        self.transform = None
+        self.clip = None
+        while True:
+            if isinstance(cmd, SaveLayer) and not self.save_layer and not self.transform and not self.clip:
+                self.save_layer = cmd
+            elif isinstance(cmd, Transform) and not self.transform and not self.clip:
+                self.transform = cmd
+            elif isinstance(cmd, ClipRRect) and not self.clip:
+                self.clip = cmd
+            else:
+                break
+            if isinstance(cmd, ClipRRect) or len(cmd.children) != 1:
+                break
+            cmd = cmd.children[0]
+        last = self.clip or self.transform or self.save_layer
+        if self.clip:
+            children = reorder_by_z_index(self.clip.children)
+        else:
+            children = last.children
+        self.background = None
+        if self.clip and self.clip.has_background and children:
+            self.background = children[0]
+            children = children[1:]
+        self.children = children
+        self.blur = self.save_layer.blur if self.save_layer and self.save_layer.should_save else 0
+        self.content_key = (
+            self.blur,
+            (self.clip.signature()[1:4]) if self.clip else None,
+            self.background.signature() if self.background else None,
+            tuple(cmd.signature() for cmd in self.children),
+        )
+        self.scroll = self.clip.scroll if self.clip else 0
+        # opacity and blend mode apply to the layer as a whole, which is
+        # what drawing its image with them does
+        paint_key = None
+        if self.save_layer and self.save_layer.should_save:
+            self.paint = skia.Paint(self.save_layer.sk_paint)
+            paint_key = (self.paint.getAlphaf(), int(self.paint.getBlendMode()))
+        else:
+            self.paint = skia.Paint()
+        self.paint.setFilterQuality(skia.kLow_FilterQuality)
+        self.composite_key = (
+            paint_key,
+            tuple(self.transform.transform_cmds) if self.transform else (),
+            self.scroll,
+        )
+
+def is_layer(cmd):
+    if isinstance(cmd, SaveLayer):
+        return cmd.should_paint_cmds
+    return isinstance(cmd, (Transform, ClipRRect))
+
+def device_rect(rect, scale):
+    # the smallest rect of whole device pixels covering rect
+    return skia.IRect.MakeLTRB(
+        math.floor(rect.left() * scale), math.floor(rect.top() * scale),
+        math.ceil(rect.right() * scale), math.ceil(rect.bottom() * scale))
+
+class LayerImage:
+    def __init__(self, image, left, top):
+        self.image = image
+        self.left = left
+        self.top = top
+
+    def pixels(self):
+        return self.image.width() * self.image.height()
+
+class Compositor:
+    # keeps rastered images of layers whose contents stay the same while
+    # their transform, opacity, blend mode or scroll offset change between
+    # commits, e.g. for animations. those are drawn from the cached image,
+    # everything else is rastered as vector commands
+    def __init__(self, scale):
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.last_composite = {}
+        self.animated = set()
+        self.parts = {}
+        self.images = OrderedDict()
+        self.pixels = 0
+        self.rastered = 0
+        self.composited = 0
+
+    def commit(self, items):
+        # a layer is promoted once a commit changes how it is composited but
+        # not its contents, and stays promoted while it is in the display list
+        last_composite = {}
+        parts_by_item = {}
+        animated = set()
+        for item in items:
+            if not is_layer(item): continue
+            parts = LayerParts(item)
+            previous = self.last_composite.get(parts.content_key)
+            if parts.content_key in self.animated or \
+                    (previous is not None and previous != parts.composite_key):
+                animated.add(parts.content_key)
+                parts_by_item[id(item)] = parts
+            last_composite[parts.content_key] = parts.composite_key
+        with self.lock:
+            self.last_composite = last_composite
+            self.animated = animated
+            self.parts = parts_by_item
+
+    def draw(self, item, canvas, rect, fallback):
+        parts = self.parts.get(id(item))
+        if parts:
+            layer = self.layer_image(parts)
+            if layer:
+                self.composite(parts, layer, canvas)
+                return
+        fallback(item, canvas, rect)
+
+    def cached(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image:
+                self.images.move_to_end(key)
+            return image
+
+    def store(self, key, layer):
+        with self.lock:
+            if key in self.images:
+                return
+            self.images[key] = layer
+            self.pixels += layer.pixels()
+            self.rastered += 1
+            while self.pixels > MAX_LAYER_CACHE_PIXELS and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.pixels -= evicted.pixels()
+
+    def content_image(self, parts):
+        # the children of the layer without background, clip or scroll
+        key = ("content", parts.content_key)
+        layer = self.cached(key)
+        if layer: return layer
+        bounds = device_rect(join_bounds(parts.children), self.scale)
+        if bounds.isEmpty() or bounds.width() * bounds.height() > MAX_LAYER_PIXELS:
+            return None
+        surface = skia.Surface(bounds.width(), bounds.height())
+        canvas = surface.getCanvas()
+        canvas.clear(skia.ColorTRANSPARENT)
+        canvas.translate(-bounds.left(), -bounds.top())
+        for cmd in parts.children:
+            cmd.execute(canvas)
+        layer = LayerImage(surface.makeImageSnapshot(), bounds.left(), bounds.top())
+        self.store(key, layer)
+        return layer
+
+    def layer_image(self, parts):
+        # the contents scrolled, clipped and blurred, ready to be drawn with
+        # the layer's transform, opacity and blend mode
+        key = ("layer", parts.content_key, parts.scroll)
+        layer = self.cached(key)
+        if layer: return layer
+        content = self.content_image(parts)
+        if not content: return None
+        if parts.clip and parts.clip.should_clip:
+            rect = parts.clip.rect.makeOutset(1, 1)
+        else:
+            rect = join_bounds(parts.children).makeOffset(0, -parts.scroll / self.scale)
+            if parts.background:
+                rect.join(parts.background.bounds())
+        if parts.blur:
+            rect = rect.makeOutset(3 * parts.blur, 3 * parts.blur)
+        bounds = device_rect(rect, self.scale)
+        if bounds.isEmpty() or bounds.width() * bounds.height() > MAX_LAYER_PIXELS:
+            return None
+        surface = skia.Surface(bounds.width(), bounds.height())
+        canvas = surface.getCanvas()
+        canvas.clear(skia.ColorTRANSPARENT)
+        canvas.translate(-bounds.left(), -bounds.top())
+        if parts.blur:
+            scaled_blur = self.scale * parts.blur
+            canvas.saveLayer(paint=skia.Paint(ImageFilter=skia.BlurImageFilter.Make(scaled_blur, scaled_blur)))
+        if parts.clip and parts.clip.should_clip:
+            canvas.save()
+            canvas.clipRRect(layout.skia_helpers.scale_rrect(parts.clip.rrect, parts.clip.radius))
+        if parts.background:
+            parts.background.execute(canvas)
+        canvas.drawImage(content.image, content.left, content.top - parts.scroll)
+        if parts.clip and parts.clip.should_clip:
+            canvas.restore()
+        if parts.blur:
+            canvas.restore()
+        layer = LayerImage(surface.makeImageSnapshot(), bounds.left(), bounds.top())
+        self.store(key, layer)
+        return layer
+
+    def composite(self, parts, layer, canvas):
+        canvas.save()
+        if parts.transform and parts.transform.transform_cmds:
+            matrix = parts.transform.matrix()
+            # the matrix is in page coordinates, the canvas in device pixels
+            canvas.scale(self.scale, self.scale)
+            canvas.concat(matrix)
+            canvas.scale(1 / self.scale, 1 / self.scale)
+        canvas.drawImage(layer.image, layer.left, layer.top, parts.paint)
+        canvas.restore()
+        with self.lock:
+            self.composited += 1
+
+    def text(self):
+        return "Layers: {} rastered, {} composited, {} animated, {} cached ({} pixels)".format(
+            self.rastered, self.composited, len(self.animated), len(self.images), self.pixels)
@@ -0,0 +1,128 @@
+import socket
+import ssl
+import select
+import threading
+import time
+
+KEEP_ALIVE_TIMEOUT_SEC = 5
+MAX_CONNECTIONS_PER_HOST = 6
+# a connection that is never released must not block its host forever, after
+# waiting this long a request gets a new connection over the limit
+ACQUIRE_TIMEOUT_SEC = 10
+
+class Connection:
+    def __init__(self, key, sock):
+        self.key = key
+        self.socket = sock
+        self.file = sock.makefile("rb")
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def send(self, data):
+        self.socket.sendall(data)
+
+    def is_expired(self, now, idle_timeout):
+        return now - self.last_used > idle_timeout
+
+    def is_readable(self):
+        # an idle keep-alive connection must not have anything to read, if it does
+        # the server either closed it (EOF) or sent garbage, both make it unusable
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return len(readable) > 0
+
+    def close(self):
+        try:
+            self.file.close()
+            self.socket.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    def __init__(self, idle_timeout=KEEP_ALIVE_TIMEOUT_SEC, max_per_host=MAX_CONNECTIONS_PER_HOST):
+        self.idle_timeout = idle_timeout
+        self.max_per_host = max_per_host
+        self.idle = {}
+        self.active = {}
+        self.tls_sessions = {}
+        self.ssl_context = ssl.create_default_context()
+        self.condition = threading.Condition()
+
+    def acquire(self, scheme, host, port, timeout=ACQUIRE_TIMEOUT_SEC):
+        key = (scheme, host, port)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                self.close_expired(key)
+                idle = self.idle.get(key)
+                if idle:
+                    # most recently used connection is the least likely to be closed by the server
+                    conn = idle.pop()
+                    conn.reused = True
+                    self.active[key] = self.active.get(key, 0) + 1
+                    return conn
+                remaining = deadline - time.monotonic()
+                if self.active.get(key, 0) < self.max_per_host or remaining <= 0:
+                    self.active[key] = self.active.get(key, 0) + 1
+                    tls_session = self.tls_sessions.get(key)
+                    break
+                self.condition.wait(remaining)
+        try:
+            return self.connect(key, tls_session)
+        except BaseException:
+            with self.condition:
+                self.active[key] -= 1
+                self.condition.notify()
+            raise
+
+    def connect(self, key, tls_session):
+        scheme, host, port = key
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        if scheme == "https":
+            s = self.ssl_context.wrap_socket(s, server_hostname=host, session=tls_session)
+        try:
+            s.connect((host, port))
+        except BaseException:
+            s.close()
+            raise
+        return Connection(key, s)
+
+    def release(self, conn, reusable):
+        with self.condition:
+            key = conn.key
+            self.active[key] -= 1
+            if isinstance(conn.socket, ssl.SSLSocket) and conn.socket.session:
+                self.tls_sessions[key] = conn.socket.session
+            if reusable:
+                conn.last_used = time.monotonic()
+                self.idle.setdefault(key, []).append(conn)
+            else:
+                conn.close()
+            self.condition.notify()
+
+    def close_expired(self, key):
+        idle = self.idle.get(key)
+        if not idle: return
+        now = time.monotonic()
+        alive = []
+        for conn in idle:
+            if conn.is_expired(now, self.idle_timeout) or conn.is_readable():
+                conn.close()
+            else:
+                alive.append(conn)
+        self.idle[key] = alive
+
+    def close_all(self):
+        with self.condition:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+CONNECTION_POOL = ConnectionPool()
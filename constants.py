@@ -4,4 +4,6 @@ HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
 CHROME_PX = 100
 INPUT_WIDTH_PX = 200
-REFRESH_RATE_SEC = 0.016
\ No newline at end of file
+REFRESH_RATE_SEC = 0.016
+PROGRESSIVE_RENDER_INTERVAL_SEC = 0.25
+TILE_SIZE = 256
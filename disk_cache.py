@@ -0,0 +1,203 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+MAX_DISK_CACHE_SIZE_BYTES = 256 * 1024 * 1024
+INDEX_FILE = "index.json"
+BODY_SUFFIX = ".body"
+# changes to the index are appended to the journal, which is folded into the
+# index file on startup, on close and once it has this many records
+JOURNAL_FILE = "journal.jsonl"
+MAX_JOURNAL_RECORDS = 1000
+
+def write_atomically(path, data):
+    # write to a temporary file in the same directory and rename it over the
+    # target, so a crash leaves either the old or the new file but never half of one
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_mapped(path, size):
+    if size == 0:
+        return ""
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # decode straight from the mapped pages instead of reading into a bytes buffer first
+            return str(mapped, "utf8")
+
+class DiskCache:
+    def __init__(self, directory, max_size=MAX_DISK_CACHE_SIZE_BYTES):
+        self.directory = directory
+        self.max_size = max_size
+        self.index = {}
+        self.size = 0
+        self.evictions = 0
+        self.journal = None
+        self.journal_records = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.load_index()
+
+    def index_path(self):
+        return os.path.join(self.directory, INDEX_FILE)
+
+    def journal_path(self):
+        return os.path.join(self.directory, JOURNAL_FILE)
+
+    def body_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load_index(self):
+        try:
+            with open(self.index_path(), "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        replayed = 0
+        try:
+            with open(self.journal_path(), "r") as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # the last line is cut short if the process died while writing it
+                        break
+                    if "record" in change:
+                        index[change["url"]] = change["record"]
+                    else:
+                        index.pop(change["url"], None)
+                    replayed += 1
+        except OSError:
+            pass
+        # drop entries whose body didn't make it to disk and bodies no entry refers to
+        for url, record in index.items():
+            path = self.body_path(record["file"])
+            if os.path.exists(path) and os.path.getsize(path) == record["size"]:
+                self.index[url] = record
+                self.size += record["size"]
+        referenced = set(record["file"] for record in self.index.values())
+        for name in os.listdir(self.directory):
+            if (name.endswith(BODY_SUFFIX) and name not in referenced) or name.endswith(".tmp"):
+                os.remove(self.body_path(name))
+        self.evict()
+        if replayed:
+            self.save_index()
+
+    def save_index(self):
+        # a crash before the journal is truncated replays it onto the new
+        # index, which changes nothing
+        write_atomically(self.index_path(), json.dumps(self.index).encode("utf8"))
+        if self.journal:
+            self.journal.close()
+        self.journal = open(self.journal_path(), "w")
+        self.journal_records = 0
+
+    def log(self, url, record=None):
+        # one line per change instead of rewriting the whole index
+        if self.journal_records >= MAX_JOURNAL_RECORDS:
+            self.save_index()
+            return
+        if not self.journal:
+            self.journal = open(self.journal_path(), "a")
+        change = {"url": url}
+        if record is not None:
+            change["record"] = record
+        self.journal.write(json.dumps(change) + "\n")
+        self.journal.flush()
+        self.journal_records += 1
+
+    def load(self, url):
+        # returns (headers, body, expires_at) with expires_at in wall-clock seconds
+        with self.lock:
+            record = self.index.get(url)
+            if not record:
+                return None
+            try:
+                body = read_mapped(self.body_path(record["file"]), record["size"])
+            except (OSError, ValueError):
+                self.remove(url)
+                return None
+            record["last_access"] = time.time()
+            return dict(record["headers"]), body, record["expires_at"]
+
+    def store(self, url, headers, body, expires_at):
+        data = body.encode("utf8")
+        if len(data) > self.max_size:
+            return
+        name = hashlib.sha256(url.encode("utf8")).hexdigest() + BODY_SUFFIX
+        with self.lock:
+            self.remove(url)
+            write_atomically(self.body_path(name), data)
+            record = {
+                "file": name,
+                "headers": headers,
+                "size": len(data),
+                "expires_at": expires_at,
+                "last_access": time.time(),
+            }
+            self.index[url] = record
+            self.size += len(data)
+            self.log(url, record)
+            self.evict()
+
+    def update(self, url, headers, expires_at):
+        with self.lock:
+            record = self.index.get(url)
+            if not record:
+                return
+            record["headers"] = headers
+            record["expires_at"] = expires_at
+            record["last_access"] = time.time()
+            self.log(url, record)
+
+    def delete(self, url):
+        with self.lock:
+            self.remove(url)
+
+    def clear(self):
+        with self.lock:
+            for url in list(self.index):
+                self.remove(url)
+            self.save_index()
+
+    def close(self):
+        with self.lock:
+            if self.journal_records:
+                self.save_index()
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+    def remove(self, url):
+        record = self.index.pop(url, None)
+        if not record:
+            return
+        self.size -= record["size"]
+        try:
+            os.remove(self.body_path(record["file"]))
+        except OSError:
+            pass
+        self.log(url)
+
+    def evict(self):
+        if self.size <= self.max_size:
+            return
+        by_last_access = sorted(self.index.items(), key=lambda item: item[1]["last_access"])
+        for url, _ in by_last_access:
+            if self.size <= self.max_size:
+                break
+            self.remove(url)
+            self.evictions += 1
@@ -1,18 +1,25 @@
 from layout.canvas_layout import add_draw_cmd
 from layout.inline_layout import get_font
 from layout.drawing import DrawRect, DrawText
-from parser import HTMLParser, Element
-from style import CSSParser
+from parser import HTMLParser, Element, mark_style_dirty, mark_tree_style_dirty, mark_children_dirty, mark_layout_dirty, mark_has_dirty
+from style import CSSParser, selector_keys, parse_selector, matcher
 from helpers import tree_to_list, node_tree_to_html, resolve_url, url_origin, parse_cookie_string, is_cookie_expired
 from request import request, COOKIE_JAR
 import dukpy
 import threading
-from taskrunner import Task
+from taskrunner import Task, TIMER_PRIORITY, NETWORK_PRIORITY
 
 EVENT_DISPATCH_CODE = "new Node(dukpy.handle).dispatchEvent(new Event(dukpy.type))"
 SETTIMEOUT_CODE = "__runSetTimeout(dukpy.handle)"
 SETINTERVAL_CODE = "__runSetInterval(dukpy.handle)"
+
+# timers nested deeper than this are delayed by at least MIN_NESTED_TIMER_MS,
+# as in the HTML spec. interval ticks count as nesting, so intervals are
+# always at least that long
+MAX_TIMER_NESTING_LEVEL = 5
+MIN_NESTED_TIMER_MS = 4
 XHR_ONLOAD_CODE = "__runXHROnload(dukpy.out, dukpy.handle)"
+END_TASK_CODE = "__endTask()"
 
 class JSContext:
     def __init__(self, tab):
@@ -20,58 +27,85 @@ class JSContext:
         self.interp = dukpy.JSInterpreter()
         self.interp.export_function("log", print)
         self.interp.export_function("querySelectorAll", self.querySelectorAll)
+        self.interp.export_function("getElementById", self.get_element_by_id)
+        self.interp.export_function("getElementsByClassName", self.get_elements_by_class_name)
         self.interp.export_function("getAttribute", self.getAttribute)
-        self.interp.export_function("innerHTML_set", self.innerHTML_set)
         self.interp.export_function("innerHTML_get", self.innerHTML_get)
         self.interp.export_function("outerHTML_get", self.outerHTML_get)
         self.interp.export_function("children", self.children)
-        self.interp.export_function("createElement", self.create_element)
-        self.interp.export_function("appendChild", self.append_child)
-        self.interp.export_function("insertBefore", self.insert_before)
-        self.interp.export_function("removeChild", self.remove_child)
-        self.interp.export_function("canvas.fillRect", self.fill_rect)
-        self.interp.export_function("canvas.fillText", self.fill_text)
         self.interp.export_function("getStyle", self.get_style)
-        self.interp.export_function("setStyle", self.set_style)
+        self.interp.export_function("applyDOMCommands", self.apply_dom_commands)
+        self.interp.export_function("removeChild", self.remove_child)
         self.interp.export_function("XMLHttpRequest_send", self.XMLHttpRequest_send)
         self.interp.export_function("get_cookie", self.get_cookie)
         self.interp.export_function("set_cookie", self.set_cookie)
         self.interp.export_function("setTimeout", self.setTimeout)
         self.interp.export_function("setInterval", self.setInterval)
+        self.interp.export_function("clearTimer", self.clear_timer)
         self.interp.export_function("requestAnimationFrame", self.requestAnimationFrame)
         with open("runtime.js") as f:
             self.interp.evaljs(f.read())
         self.node_to_handle = {}
         self.handle_to_node = {}
-        self.add_global_vars_for_tree(self.tab.nodes)
+        self.next_handle = 0
+        # mutations runtime.js buffers and sends in one applyDOMCommands call
+        self.dom_commands = {
+            "createElement": self.create_element,
+            "appendChild": self.append_child,
+            "insertBefore": self.insert_before,
+            "innerHTML_set": self.innerHTML_set,
+            "setStyle": self.set_style,
+            "canvas.fillRect": self.fill_rect,
+            "canvas.fillText": self.fill_text,
+        }
+        self.timer_nesting_level = 0
+        self.pending_intervals = set()
+        self.discarded = False
+        self.update_global_vars([elt for elts in self.tab.dom_index.by_id.values() for elt in elts])
+
+    def discard(self):
+        # the tab navigated away, tasks already queued for this context
+        # don't run any more script
+        self.discarded = True
+
+    def evaljs(self, code, **kwargs):
+        if self.discarded:
+            return None
+        # every task that runs script ends by applying the DOM mutations
+        # runtime.js buffered, even if the script threw
+        try:
+            return self.interp.evaljs(code, **kwargs)
+        finally:
+            self.interp.evaljs(END_TASK_CODE)
 
     def run(self, code):
-        return self.interp.evaljs(code)
-    
-    def clear_global_vars_for_tree(self, node):
-        nodes_with_id = [node for node in tree_to_list(node, [])
-                    if isinstance(node, Element) and node.attributes.get("id", "") != ""]
-        if "id" in node.attributes:
-            nodes_with_id.append(node)
-        for node in nodes_with_id:
-            id = node.attributes.get("id")
-            self.run("{} = undefined;".format(id))
+        return self.evaljs(code)
 
-    def add_global_vars_for_tree(self, node):
-        nodes_with_id = [node for node in tree_to_list(node, [])
-                          if isinstance(node, Element) and node.attributes.get("id", "") != ""]
-        if isinstance(node, Element) and "id" in node.attributes:
-            nodes_with_id.append(node)
-        for node in nodes_with_id:
-            id = node.attributes.get("id")
+    def apply_dom_commands(self, commands):
+        # a command that fails is reported and skipped, so one bad handle
+        # doesn't drop the DOM writes that come after it
+        for command in commands:
+            try:
+                self.dom_commands[command[0]](*command[1:])
+            except Exception as e:
+                print("DOM command", command[0], "failed:", repr(e))
+    
+    def update_global_vars(self, elements):
+        # elements with an id were added to or removed from the document,
+        # the global variable for an id is the first element that has it
+        for id in set(elt.attributes.get("id") for elt in elements):
             if not id or not id.isalpha():
                 continue
-            handle = self.get_handle(node)
-            self.run("var {} = new Node({});".format(id, handle))
+            elt = self.tab.dom_index.element_by_id(id, self.tab.nodes)
+            if elt:
+                self.interp.evaljs("var {} = new Node({});".format(id, self.get_handle(elt)))
+            else:
+                self.interp.evaljs("{} = undefined;".format(id))
 
     def get_handle(self, elt):
         if elt not in self.node_to_handle:
-            handle = len(self.node_to_handle)
+            handle = self.next_handle
+            self.next_handle += 1
             self.node_to_handle[elt] = handle
             self.handle_to_node[handle] = elt
         else:
@@ -79,8 +113,24 @@ class JSContext:
         return handle
 
     def querySelectorAll(self, selector_text):
-        selector = CSSParser(selector_text).selector()
-        nodes = [node for node in tree_to_list(self.tab.nodes, []) if selector.matches(node)]
+        # matched against the smallest set of indexed elements that has
+        # everything the rightmost part of the selector needs
+        selector = parse_selector(selector_text)
+        match = matcher(selector)
+        keys = selector_keys(selector)
+        if not keys:
+            nodes = [node for node in tree_to_list(self.tab.nodes, []) if match(node)]
+            return [self.get_handle(node) for node in nodes]
+        index = self.tab.dom_index
+        nodes = [node for node in index.smallest(keys) if match(node)]
+        return [self.get_handle(node) for node in index.in_document_order(nodes, self.tab.nodes)]
+
+    def get_element_by_id(self, id):
+        elt = self.tab.dom_index.element_by_id(id, self.tab.nodes)
+        return self.get_handle(elt) if elt else None
+
+    def get_elements_by_class_name(self, names):
+        nodes = self.tab.dom_index.elements_by_class_name(names, self.tab.nodes)
         return [self.get_handle(node) for node in nodes]
     
     def getAttribute(self, handle, attr):
@@ -89,17 +139,28 @@ class JSContext:
     
     def dispatch_event(self, type, elt):
         handle = self.node_to_handle.get(elt, -1)
-        ret = self.interp.evaljs(EVENT_DISPATCH_CODE, type=type, handle=handle)
+        ret = self.evaljs(EVENT_DISPATCH_CODE, type=type, handle=handle)
         return ret["do_default"], ret["stop_propagation"]
 
     def innerHTML_set(self, handle, s):
         doc = HTMLParser("<html><body>" + s + "</body></html>").parse()
         new_nodes = doc.children[0].children
         elt = self.handle_to_node[handle]
+        index = self.tab.dom_index
+        changed = []
+        in_document = index.contains(elt)
+        if in_document:
+            for child in elt.children:
+                changed += index.remove_tree(child)
         elt.children = new_nodes
         for child in elt.children:
             child.parent = elt
-            self.add_global_vars_for_tree(child)
+            if in_document:
+                changed += index.add_tree(child)
+        self.update_global_vars(changed)
+        mark_children_dirty(elt)
+        mark_layout_dirty(elt)
+        mark_has_dirty(elt)
         self.tab.set_needs_render()
     
     def innerHTML_get(self, handle):
@@ -117,20 +178,48 @@ class JSContext:
         handles = [self.get_handle(child) for child in elt.children if isinstance(child, Element)]
         return handles
 
-    def create_element(self, tagName):
+    def create_element(self, tagName, handle):
+        # the handle was picked by runtime.js
         elt = Element(tagName, {}, None)
-        return self.get_handle(elt)
+        self.node_to_handle[elt] = handle
+        self.handle_to_node[handle] = elt
 
     def append_child(self, handle, child_handle):
         if not handle in self.handle_to_node or not child_handle in self.handle_to_node:
             return
         node = self.handle_to_node[handle]
         child = self.handle_to_node[child_handle]
+        self.detach(child, node)
         node.children.append(child)
         child.parent = node
-        self.add_global_vars_for_tree(node)
+        mark_tree_style_dirty(child)
+        mark_layout_dirty(node)
+        mark_has_dirty(node)
+        self.update_index(node, child)
         self.tab.set_needs_render()
 
+    def detach(self, node, new_parent):
+        # a node inserted somewhere else leaves its old parent
+        old_parent = node.parent
+        if not old_parent or old_parent is new_parent or node not in old_parent.children:
+            return
+        old_parent.children.remove(node)
+        mark_children_dirty(old_parent)
+        mark_layout_dirty(old_parent)
+        mark_has_dirty(old_parent)
+
+    def update_index(self, parent, node):
+        # node was inserted under parent, it is indexed exactly while parent
+        # is in the document
+        index = self.tab.dom_index
+        if index.contains(parent):
+            changed = index.add_tree(node)
+        elif index.contains(node):
+            changed = index.remove_tree(node)
+        else:
+            return
+        self.update_global_vars(changed)
+
     def insert_before(self, handle, new_node_handle, child_handle):
         assert handle in self.handle_to_node, "can't find matching parent for handle"
         assert new_node_handle in self.handle_to_node, "can't find matching new_node for handle"
@@ -143,6 +232,7 @@ class JSContext:
             child = self.handle_to_node[child_handle]
             assert child in node.children, "child node is not a child of parent"
             child_index = node.children.index(child)
+        self.detach(new_node, node)
         if new_node in node.children:
             deleted_node_index = node.children.index(new_node)
             node.children.remove(new_node)
@@ -153,7 +243,10 @@ class JSContext:
         else:
             node.children.append(new_node)
         new_node.parent = node
-        self.add_global_vars_for_tree(new_node)
+        mark_tree_style_dirty(new_node)
+        mark_layout_dirty(node)
+        mark_has_dirty(node)
+        self.update_index(node, new_node)
         self.tab.set_needs_render()
 
     def remove_child(self, handle, child_handle):
@@ -164,8 +257,14 @@ class JSContext:
         assert child in parent.children, "child node is not a child of parent"
         parent.children.remove(child)
         child.parent = None
+        removed = []
+        if self.tab.dom_index.contains(child):
+            removed = self.tab.dom_index.remove_tree(child)
+        mark_children_dirty(parent)
+        mark_layout_dirty(parent)
+        mark_has_dirty(parent)
         self.tab.set_needs_render()
-        self.clear_global_vars_for_tree(child)
+        self.update_global_vars(removed)
         return child_handle
     
     def fill_rect(self, handle, x, y, w, h, fillStyle):
@@ -205,6 +304,7 @@ class JSContext:
         for attr in rules:
             cssText += "{}: {};".format(attr, rules[attr])
         elt.attributes["style"] = cssText
+        mark_style_dirty(elt)
         # only call render if document is already fully loaded
         if self.tab.document:
             self.tab.set_needs_render()
@@ -228,7 +328,7 @@ class JSContext:
         def run_load():
             headers, response, _ = request(full_url, self.tab.url, payload=body) # referrer policy?
             task = Task(self.dispatch_xhr_onload, response, handle)
-            self.tab.task_runner.schedule_task(task)
+            self.tab.task_runner.schedule_task(task, NETWORK_PRIORITY)
             if not isasync:
                 return response
         if not isasync:
@@ -237,7 +337,7 @@ class JSContext:
             threading.Thread(target=run_load).start()
     
     def dispatch_xhr_onload(self, out, handle):
-        do_default = self.interp.evaljs(XHR_ONLOAD_CODE, out=out, handle=handle)
+        do_default = self.evaljs(XHR_ONLOAD_CODE, out=out, handle=handle)
 
     def get_cookie(self):
         _, _, host, _ = self.tab.url.split("/", 3)
@@ -264,24 +364,44 @@ class JSContext:
                 return
         COOKIE_JAR[host] = parse_cookie_string(new_cookie)
     
-    def dispatch_settimeout(self, handle):
-        self.interp.evaljs(SETTIMEOUT_CODE, handle=handle)
+    def dispatch_settimeout(self, handle, nesting_level):
+        self.timer_nesting_level = nesting_level
+        try:
+            self.evaljs(SETTIMEOUT_CODE, handle=handle)
+        finally:
+            self.timer_nesting_level = 0
 
     def setTimeout(self, handle, time):
+        time = time or 0
+        if self.timer_nesting_level > MAX_TIMER_NESTING_LEVEL:
+            time = max(time, MIN_NESTED_TIMER_MS)
+        nesting_level = self.timer_nesting_level + 1
         def run_callback():
-            task = Task(self.dispatch_settimeout, handle)
-            self.tab.task_runner.schedule_task(task)
-        threading.Timer(time / 1000.0, run_callback).start()
+            task = Task(self.dispatch_settimeout, handle, nesting_level)
+            self.tab.task_runner.schedule_task(task, TIMER_PRIORITY)
+        self.tab.timers.add(handle, time / 1000.0, run_callback)
     
-    def dispatch_setinterval(self, handle, time):
-        self.interp.evaljs(SETINTERVAL_CODE, handle=handle)
-        self.setInterval(handle, time)
+    def dispatch_setinterval(self, handle):
+        self.pending_intervals.discard(handle)
+        self.timer_nesting_level = MAX_TIMER_NESTING_LEVEL + 1
+        try:
+            self.evaljs(SETINTERVAL_CODE, handle=handle)
+        finally:
+            self.timer_nesting_level = 0
     
     def setInterval(self, handle, time):
+        interval = max(time or 0, MIN_NESTED_TIMER_MS) / 1000.0
         def run_callback():
-            task = Task(self.dispatch_setinterval, handle, time)
-            self.tab.task_runner.schedule_task(task)
-        threading.Timer(time / 1000.0, run_callback).start()
+            # a tick whose task hasn't run yet isn't queued again
+            if handle in self.pending_intervals:
+                return
+            self.pending_intervals.add(handle)
+            task = Task(self.dispatch_setinterval, handle)
+            self.tab.task_runner.schedule_task(task, TIMER_PRIORITY)
+        self.tab.timers.add(handle, interval, run_callback, interval)
+
+    def clear_timer(self, handle):
+        self.tab.timers.cancel(handle)
     
     def requestAnimationFrame(self):
         self.tab.browser.set_needs_animation_frame(self.tab)
\ No newline at end of file
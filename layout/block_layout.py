@@ -1,4 +1,4 @@
-from parser import Text, Element
+from parser import Text, Element, needs_layout, clear_layout_dirty
 from .inline_layout import InlineLayout
 from .canvas_layout import CanvasLayout
 from .drawing import DrawRRect, paint_visual_effects
@@ -19,11 +19,16 @@ def layout_mode(node):
         return "block"
 
 class BlockLayout:
+    __slots__ = ("node", "parent", "previous", "children", "x", "y", "width", "height")
+
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
         self.previous = previous
         self.children = []
+        self.x = None
+        self.y = None
+        self.width = None
 
     def compute_width(self):
         css_width = self.node.style.get('width', 'auto')
@@ -42,25 +47,51 @@ class BlockLayout:
             self.height = int(css_height[:-2])
     
     def layout(self):
+        old_x, old_width = self.x, self.width
         self.compute_width()
         self.x = self.parent.x
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
+            y = self.parent.y
+        # nothing in the subtree changed and the box only moved vertically,
+        # so the previous layout is still valid up to a shift
+        if self.y is not None and not needs_layout(self.node) \
+            and self.x == old_x and self.width == old_width:
+            self.shift(y - self.y)
+            return
+        self.y = y
+        # keep the layout objects of children that are still there, they only
+        # redo their own layout if their subtree changed
+        old_children = {child.node: child for child in self.children}
+        self.children = []
         previous = None
         for child in self.node.children:
-            if isinstance(child, Element) and child.tag == "head": continue
-            if isinstance(child, Element) and child.tag == "canvas": next = CanvasLayout(child, self, previous)
+            if isinstance(child, Element) and child.tag == "head":
+                clear_layout_dirty(child)
+                continue
+            if isinstance(child, Element) and child.tag == "canvas": layout_class = CanvasLayout
             elif layout_mode(child) == "inline":
-                next = InlineLayout(child, self, previous)
+                layout_class = InlineLayout
+            else:
+                layout_class = BlockLayout
+            next = old_children.get(child)
+            if type(next) is layout_class:
+                next.previous = previous
             else:
-                next = BlockLayout(child, self, previous)
+                next = layout_class(child, self, previous)
             self.children.append(next)
             previous = next
         for child in self.children:
             child.layout()
         self.compute_height()
+        self.node.layout_dirty = False
+        self.node.children_layout_dirty = False
+
+    def shift(self, dy):
+        self.y += dy
+        for child in self.children:
+            child.shift(dy)
     
     def paint(self, display_list):
         cmds = []
@@ -1,5 +1,6 @@
 from copy import copy
 from .drawing import DrawRect, DrawText
+from parser import clear_layout_dirty
 
 canvasContexts = {}
 
@@ -9,6 +10,8 @@ def add_draw_cmd(node, draw_cmd):
     canvasContexts[node].append(draw_cmd)
 
 class CanvasLayout:
+    __slots__ = ("node", "parent", "previous", "children", "x", "y", "width", "height")
+
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
@@ -23,6 +26,10 @@ class CanvasLayout:
             self.y = self.parent.y
         self.width = 300
         self.height = 150
+        clear_layout_dirty(self.node)
+
+    def shift(self, dy):
+        self.y += dy
 
     def paint(self, display_list):
         display_list.append(DrawRect(self.x, self.y, self.x + self.width, self.y + self.height, "white"))
@@ -2,18 +2,20 @@ from constants import WIDTH, HSTEP, VSTEP
 from .block_layout import BlockLayout
 
 class DocumentLayout:
+    __slots__ = ("node", "parent", "children", "x", "y", "width", "height")
+
     def __init__(self, node):
         self.node = node
         self.parent = node
         self.children = []
     
     def layout(self, width = WIDTH):
-        self.children = []
         self.width = width - 2 * HSTEP
         self.x = HSTEP
         self.y = VSTEP
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
+        if not self.children:
+            self.children.append(BlockLayout(self.node, self, None))
+        child = self.children[0]
         child.layout()
         self.height = child.height + 2 * VSTEP
     
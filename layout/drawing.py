@@ -1,17 +1,33 @@
+import math
 import skia
 import layout.skia_helpers
 from .skia_helpers import draw_line, draw_text, draw_rect, draw_rrect, scale_rrect
+from .fonts import measure_text, line_height
 from transform_parser import TransformParser
 
+# bounds() of a command covers every pixel it can touch, in page coordinates,
+# including antialiasing, glyph overhang and blur. signature() is a value
+# that compares equal for two commands that draw the same pixels.
+# glyphs can extend a bit past their advance width and line height
+TEXT_BOUNDS_OUTSET = 2
+
+def ltrb(rect):
+    return (rect.left(), rect.top(), rect.right(), rect.bottom())
+
+def join_bounds(cmds):
+    rect = skia.Rect.MakeEmpty()
+    for cmd in cmds:
+        rect.join(cmd.bounds())
+    return rect
+
 class DrawText:
     def __init__(self, x1, y1, text, font, color):
         self.top = y1
         self.left = x1
-        self.right = x1 + font.measureText(text)
+        self.right = x1 + measure_text(font, text)
         self.text = text
         self.font = font
-        lineheight = font.getMetrics().fDescent - font.getMetrics().fAscent
-        self.bottom = y1 + lineheight
+        self.bottom = y1 + line_height(font)
         self.color = color
         self.rect = skia.Rect.MakeLTRB(x1, y1, self.right, self.bottom)
     
@@ -25,6 +41,14 @@ class DrawText:
             self.color
         )
 
+    def bounds(self):
+        return skia.Rect.MakeLTRB(self.left, self.top, self.right, self.bottom).makeOutset(
+            TEXT_BOUNDS_OUTSET, TEXT_BOUNDS_OUTSET)
+
+    def signature(self):
+        font_key = getattr(self.font, "key", None) or id(self.font)
+        return ("text", self.left, self.top, self.text, font_key, self.color)
+
 
 class DrawRect:
     def __init__(self, x1, y1, x2, y2, color):
@@ -46,6 +70,12 @@ class DrawRect:
             width=0
         )
 
+    def bounds(self):
+        return skia.Rect.MakeLTRB(self.left, self.top, self.right, self.bottom).makeOutset(1, 1)
+
+    def signature(self):
+        return ("rect", self.left, self.top, self.right, self.bottom, self.color)
+
 class DrawRRect:
     def __init__(self, rect, radius, color):
         self.rect = rect
@@ -61,6 +91,12 @@ class DrawRRect:
     def execute(self, canvas):
         draw_rrect(canvas, self.rrect, self.radius, self.color)
 
+    def bounds(self):
+        return self.rect.makeOutset(1, 1)
+
+    def signature(self):
+        return ("rrect", ltrb(self.rect), self.radius, self.color)
+
 class DrawLine:
     def __init__(self, x1, y1, x2, y2):
         self.rect = skia.Rect.MakeLTRB(x1, y1, x2, y2)
@@ -72,12 +108,20 @@ class DrawLine:
     def execute(self, canvas):
         draw_line(canvas, self.x1, self.x1, self.x2, self.y2)
 
+    def bounds(self):
+        return skia.Rect.MakeLTRB(min(self.x1, self.x2), min(self.x1, self.y2),
+            max(self.x1, self.x2), max(self.x1, self.y2)).makeOutset(1, 1)
+
+    def signature(self):
+        return ("line", self.x1, self.y1, self.x2, self.y2)
+
 class DrawCheckmark:
     def __init__(self, x1, y1, x2, y2):
         self.top = y1
         self.left = x1
         self.bottom = y2
         self.right = x2
+        self.rect = skia.Rect.MakeLTRB(x1, y1, x2, y2)
 
     def execute(self, canvas):
         draw_line(canvas,
@@ -87,6 +131,12 @@ class DrawCheckmark:
             self.left + 1, self.bottom - 1,
             self.right - 1, self.top + 1, width=2)
 
+    def bounds(self):
+        return skia.Rect.MakeLTRB(self.left, self.top, self.right, self.bottom).makeOutset(1, 1)
+
+    def signature(self):
+        return ("checkmark", self.left, self.top, self.right, self.bottom)
+
 class SaveLayer:
     def __init__(self, sk_paint, children, should_save=True, should_paint_cmds=True, blur=0, z_index=0):
         self.sk_paint = sk_paint
@@ -98,19 +148,56 @@ class SaveLayer:
             self.rect.join(cmd.rect)
         self.blur = blur
         self.z_index = z_index
+        self.cached_bounds = None
+        self.cached_signature = None
+        self.index = None
     
     def execute(self, canvas):
+        self.execute_culled(canvas, None)
+
+    def execute_culled(self, canvas, rect):
         if self.should_save:
+            paint = self.sk_paint
             if self.blur != 0:
+                # commands are shared between raster threads, so don't modify the paint
+                paint = skia.Paint(self.sk_paint)
                 scaled_blur = layout.skia_helpers.scale_factor * self.blur
-                self.sk_paint.setImageFilter(skia.BlurImageFilter.Make(scaled_blur, scaled_blur))
-            canvas.saveLayer(paint=self.sk_paint)
+                paint.setImageFilter(skia.BlurImageFilter.Make(scaled_blur, scaled_blur))
+                # blurred pixels in rect depend on content just outside of it
+                if rect:
+                    rect = rect.makeOutset(3 * self.blur, 3 * self.blur)
+            canvas.saveLayer(paint=paint)
         if self.should_paint_cmds:
-            for cmd in self.children:
-                cmd.execute(canvas)
+            if not self.index:
+                self.index = DisplayListIndex(self.children)
+            self.index.execute(canvas, rect)
         if self.should_save:
             canvas.restore()
 
+    def is_transparent(self):
+        # a layer that is not saved just paints its children in order
+        return not self.should_save and self.should_paint_cmds
+
+    def bounds(self):
+        if self.cached_bounds is None:
+            if not self.should_paint_cmds:
+                self.cached_bounds = skia.Rect.MakeEmpty()
+            else:
+                self.cached_bounds = join_bounds(self.children)
+                if self.should_save and self.blur:
+                    self.cached_bounds = self.cached_bounds.makeOutset(3 * self.blur, 3 * self.blur)
+        return self.cached_bounds
+
+    def signature(self):
+        if self.cached_signature is None:
+            self.cached_signature = ("layer", self.should_save, self.should_paint_cmds, self.blur, self.z_index,
+                self.sk_paint.getAlphaf(), int(self.sk_paint.getBlendMode()),
+                tuple(cmd.signature() for cmd in self.children))
+        return self.cached_signature
+
+    def painted_children(self):
+        return self.children
+
 def reorder_by_z_index(cmds):
     def order(cmd):
         if not isinstance(cmd, SaveLayer):
@@ -127,31 +214,67 @@ class ClipRRect:
         self.radius = radius
         self.scroll = scroll
         self.has_background = has_background
+        self.cached_bounds = None
+        self.cached_signature = None
+        self.index = None
     
     def execute(self, canvas):
+        self.execute_culled(canvas, None)
+
+    def execute_culled(self, canvas, rect):
         if self.should_clip:
             canvas.save()
             canvas.clipRRect(scale_rrect(self.rrect, self.radius))
         
         sorted_cmds = reorder_by_z_index(self.children)
         if self.has_background:
-            sorted_cmds[0].execute(canvas)
+            execute_culled(sorted_cmds[0], canvas, rect)
             sorted_cmds = sorted_cmds[1:]
         if self.scroll:
             canvas.translate(0, -self.scroll)
-        for cmd in sorted_cmds:
-            cmd.execute(canvas)
+            # the scroll offset is in device pixels
+            if rect:
+                rect = rect.makeOffset(0, self.scroll / layout.skia_helpers.scale_factor)
+        if not self.index:
+            self.index = DisplayListIndex(sorted_cmds)
+        self.index.execute(canvas, rect)
         
         if self.should_clip:
             canvas.restore()
 
+    def is_transparent(self):
+        return not self.should_clip and not self.scroll
+
+    def bounds(self):
+        if self.cached_bounds is None:
+            if self.should_clip:
+                self.cached_bounds = self.rect.makeOutset(1, 1)
+            else:
+                self.cached_bounds = join_bounds(self.children)
+        return self.cached_bounds
+
+    def signature(self):
+        if self.cached_signature is None:
+            self.cached_signature = ("clip", ltrb(self.rect), self.radius, self.should_clip, self.scroll,
+                self.has_background, tuple(cmd.signature() for cmd in self.children))
+        return self.cached_signature
+
+    def painted_children(self):
+        return reorder_by_z_index(self.children)
+
 class Transform:
     def __init__(self, rect, transform, children):
         self.rect = rect
         self.children = children
         self.transform_cmds = TransformParser(transform).parse()
+        self.cached_bounds = None
+        self.cached_signature = None
+        self.index = None
 
     def execute(self, canvas):
+        self.execute_culled(canvas, None)
+
+    def execute_culled(self, canvas, rect):
         should_transform = len(self.transform_cmds) > 0
         if should_transform:
             canvas.save()
@@ -167,13 +290,104 @@ class Transform:
                     scaled_x = x * layout.skia_helpers.scale_factor
                     scaled_y = y * layout.skia_helpers.scale_factor
                     canvas.translate(scaled_x, scaled_y)
+            # cull in the coordinates the children are drawn in
+            if rect:
+                inverse = skia.Matrix()
+                if self.matrix().invert(inverse):
+                    rect = inverse.mapRect(rect)
+                else:
+                    rect = None
 
-        for cmd in self.children:
-            cmd.execute(canvas)
+        if not self.index:
+            self.index = DisplayListIndex(self.children)
+        self.index.execute(canvas, rect)
 
         if should_transform:
             canvas.restore()
 
+    def is_transparent(self):
+        return len(self.transform_cmds) == 0
+
+    def matrix(self):
+        # the same transform execute applies, in page coordinates
+        matrix = skia.Matrix()
+        for transform_cmd in self.transform_cmds:
+            if transform_cmd[0] == "rotate":
+                center_x = self.rect.left() + 0.5 * (self.rect.right() - self.rect.left())
+                center_y = self.rect.top() + 0.5 * (self.rect.bottom() - self.rect.top())
+                matrix.preRotate(transform_cmd[1], center_x, center_y)
+            elif transform_cmd[0] == "translate":
+                x, y = transform_cmd[1]
+                matrix.preTranslate(x, y)
+        return matrix
+
+    def bounds(self):
+        if self.cached_bounds is None:
+            self.cached_bounds = join_bounds(self.children)
+            if self.transform_cmds and not self.cached_bounds.isEmpty():
+                self.cached_bounds = self.matrix().mapRect(self.cached_bounds).makeOutset(1, 1)
+        return self.cached_bounds
+
+    def signature(self):
+        if self.cached_signature is None:
+            self.cached_signature = ("transform", ltrb(self.rect), tuple(self.transform_cmds),
+                tuple(cmd.signature() for cmd in self.children))
+        return self.cached_signature
+
+    def painted_children(self):
+        return self.children
+
+def display_items(cmds, items=None):
+    # flattens containers that don't change how their children are drawn,
+    # what is left are leaf commands and containers with a visual effect,
+    # in painting order
+    if items is None:
+        items = []
+    for cmd in cmds:
+        if isinstance(cmd, (SaveLayer, ClipRRect, Transform)) and cmd.is_transparent():
+            display_items(cmd.painted_children(), items)
+        else:
+            items.append(cmd)
+    return items
+
+def execute_culled(cmd, canvas, rect):
+    if isinstance(cmd, (SaveLayer, ClipRRect, Transform)):
+        cmd.execute_culled(canvas, rect)
+    else:
+        cmd.execute(canvas)
+
+# height of the vertical buckets of a DisplayListIndex, in page coordinates
+INDEX_BUCKET_HEIGHT = 256
+
+class DisplayListIndex:
+    # finds the commands of a display list that intersect a rect without
+    # looking at every command. commands are put in every bucket their
+    # bounds overlap vertically and looked up by the buckets a rect overlaps
+    def __init__(self, cmds):
+        self.items = display_items(cmds)
+        self.bounds = [item.bounds() for item in self.items]
+        self.buckets = {}
+        for i, bounds in enumerate(self.bounds):
+            if bounds.isEmpty(): continue
+            for bucket in self.bucket_range(bounds.top(), bounds.bottom()):
+                self.buckets.setdefault(bucket, []).append(i)
+
+    def bucket_range(self, top, bottom):
+        return range(math.floor(top / INDEX_BUCKET_HEIGHT), math.floor(bottom / INDEX_BUCKET_HEIGHT) + 1)
+
+    def query(self, rect):
+        # the intersecting commands in painting order
+        if rect is None:
+            return [item for item, bounds in zip(self.items, self.bounds) if not bounds.isEmpty()]
+        found = set()
+        for bucket in self.bucket_range(rect.top(), rect.bottom()):
+            found.update(self.buckets.get(bucket, ()))
+        return [self.items[i] for i in sorted(found) if self.bounds[i].intersects(rect)]
+
+    def execute(self, canvas, rect):
+        for item in self.query(rect):
+            execute_culled(item, canvas, rect)
+
 def paint_visual_effects(node, cmds, rect):
     opacity = float(node.style.get("opacity", "1.0"))
     blend_mode = parse_blend_mode(node.style.get("mix-blend-mode"))
@@ -0,0 +1,168 @@
+import threading
+from collections import OrderedDict
+import skia
+
+MAX_MEASURE_CACHE_ENTRIES = 64 * 1024
+# typefaces, fonts and scaled fonts are each kept for this many of the most
+# recently used keys
+MAX_CACHED_FONTS = 1024
+
+DEFAULT_FONT_FAMILY = "Arial"
+
+class Font(skia.Font):
+    # a skia.Font that knows the (family, weight, slant, size) it was made from, so
+    # measurements can be cached without asking skia for them again
+    def __init__(self, typeface, typeface_key, size):
+        super().__init__(typeface, size)
+        self.key = typeface_key + (size,)
+
+def font_family(family):
+    # only the first family of a font-family list is used
+    if not family:
+        return DEFAULT_FONT_FAMILY
+    family = family.split(",")[0].strip().strip("\"'")
+    return family or DEFAULT_FONT_FAMILY
+
+class FontManager:
+    def __init__(self):
+        self.typefaces = OrderedDict()
+        self.fonts = OrderedDict()
+        self.scaled_fonts = OrderedDict()
+        self.lock = threading.Lock()
+        self.allocated = 0
+        self.frame_start_allocated = 0
+        self.frames = 0
+        self.last_frame_allocated = 0
+
+    def cached(self, cache, key):
+        # called with the lock held
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def store(self, cache, key, value):
+        # called with the lock held
+        cache[key] = value
+        if len(cache) > MAX_CACHED_FONTS:
+            cache.popitem(last=False)
+
+    def typeface(self, family, weight, slant):
+        # called with the lock held
+        key = (family, weight, slant)
+        typeface = self.cached(self.typefaces, key)
+        if typeface is None:
+            if weight == "bold":
+                skia_weight = skia.FontStyle.kBold_Weight
+            else:
+                skia_weight = skia.FontStyle.kNormal_Weight
+            if slant == "italic":
+                skia_slant = skia.FontStyle.kItalic_Slant
+            else:
+                skia_slant = skia.FontStyle.kUpright_Slant
+            skia_width = skia.FontStyle.kNormal_Width
+            style_info = skia.FontStyle(skia_weight, skia_width, skia_slant)
+            typeface = skia.Typeface(family, style_info)
+            self.store(self.typefaces, key, typeface)
+        return typeface
+
+    def font(self, size, weight, style, family=None):
+        weight = "bold" if weight == "bold" else "normal"
+        slant = "italic" if style == "italic" else "roman"
+        key = (font_family(family), weight, slant, size)
+        with self.lock:
+            font = self.cached(self.fonts, key)
+            if font is None:
+                font = Font(self.typeface(*key[:3]), key[:3], size)
+                self.store(self.fonts, key, font)
+                self.allocated += 1
+        return font
+
+    def scaled_font(self, font, scale):
+        # raster draws with fonts scaled to the device, keep those around
+        # instead of making a new one for every text command
+        key = getattr(font, "key", None)
+        if key is None:
+            with self.lock:
+                self.allocated += 1
+            return font.makeWithSize(font.getSize() * scale)
+        key = (key, scale)
+        with self.lock:
+            scaled = self.cached(self.scaled_fonts, key)
+            if scaled is None:
+                scaled = font.makeWithSize(font.getSize() * scale)
+                self.store(self.scaled_fonts, key, scaled)
+                self.allocated += 1
+        return scaled
+
+    def end_frame(self):
+        with self.lock:
+            self.last_frame_allocated = self.allocated - self.frame_start_allocated
+            self.frame_start_allocated = self.allocated
+            self.frames += 1
+
+    def text(self):
+        if self.frames == 0: return ""
+        return "Fonts allocated per frame on average: {:.2f} (last frame {}, {} cached, {} scaled)".format(
+            self.frame_start_allocated / self.frames, self.last_frame_allocated,
+            len(self.fonts), len(self.scaled_fonts))
+
+FONT_MANAGER = FontManager()
+
+def get_font(size, weight, style, family=None):
+    return FONT_MANAGER.font(size, weight, style, family)
+
+def get_scaled_font(font, scale):
+    return FONT_MANAGER.scaled_font(font, scale)
+
+class MeasureCache:
+    def __init__(self, max_entries=MAX_MEASURE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.widths = OrderedDict()
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def measure(self, font, text):
+        key = getattr(font, "key", None)
+        if key is None:
+            return font.measureText(text)
+        key = key + (text,)
+        with self.lock:
+            width = self.widths.get(key)
+            if width is not None:
+                self.widths.move_to_end(key)
+                return width
+        width = font.measureText(text)
+        with self.lock:
+            self.widths[key] = width
+            if len(self.widths) > self.max_entries:
+                self.widths.popitem(last=False)
+        return width
+
+    def font_metrics(self, font):
+        key = getattr(font, "key", None)
+        if key is None:
+            return font.getMetrics()
+        with self.lock:
+            metrics = self.metrics.get(key)
+            if metrics is not None:
+                self.metrics.move_to_end(key)
+                return metrics
+        metrics = font.getMetrics()
+        with self.lock:
+            self.metrics[key] = metrics
+            if len(self.metrics) > MAX_CACHED_FONTS:
+                self.metrics.popitem(last=False)
+        return metrics
+
+MEASURE_CACHE = MeasureCache()
+
+def measure_text(font, text):
+    return MEASURE_CACHE.measure(font, text)
+
+def font_metrics(font):
+    return MEASURE_CACHE.font_metrics(font)
+
+def line_height(font):
+    metrics = font_metrics(font)
+    return metrics.fDescent - metrics.fAscent
@@ -1,34 +1,19 @@
-from parser import Element, Text
+from parser import Element, Text, needs_layout, clear_layout_dirty
 from .drawing import DrawRect, DrawText, DrawCheckmark, DrawRRect
+from .fonts import get_font, measure_text, font_metrics, line_height
 from constants import INPUT_WIDTH_PX
 import skia
-
-FONTS = {}
+import sys
 
 visited_urls = {}
 
-def get_font(size, weight, style, family=None):
-    # if weight != "bold" or weight != "normal": weight = "normal"
-    key = (weight, weight, style)
-    if key not in FONTS:
-        if weight == "bold":
-            skia_weight = skia.FontStyle.kBold_Weight
-        else:
-            skia_weight = skia.FontStyle.kNormal_Weight
-        if style == "italic":
-            skia_style = skia.FontStyle.kItalic_Slant
-        else:
-            skia_style = skia.FontStyle.kUpright_Slant
-        skia_width = skia.FontStyle.kNormal_Width
-        style_info = skia.FontStyle(skia_weight, skia_width, skia_style)
-        font = skia.Typeface('Arial', style_info)
-        FONTS[key] = font
-    return skia.Font(FONTS[key], size)
-
 class InputLayout:
+    __slots__ = ("node", "parent", "previous", "is_checkbox", "is_password", "font", "x", "y", "width", "height")
+    # words never have children, share one empty tuple instead of a list per word
+    children = ()
+
     def __init__(self, node, parent, previous):
         self.node = node
-        self.children = []
         self.parent = parent
         self.previous = previous
         self.is_checkbox = self.node.tag == "input" and self.node.attributes.get("type", "") == "checkbox"
@@ -42,17 +27,20 @@ class InputLayout:
         size = int(float(self.node.style["font-size"][:-2]) * 0.75)
         self.font = get_font(size, weight, style, family)
         self.width = INPUT_WIDTH_PX
-        lineheight = self.font.getMetrics().fDescent - self.font.getMetrics().fAscent
+        lineheight = line_height(self.font)
         if self.is_checkbox:
             self.width = lineheight
 
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = measure_text(self.previous.font, " ")
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
         
         self.height = lineheight
+
+    def shift(self, dy):
+        self.y += dy
     
     def paint(self, display_list):
         bgcolor = self.node.style.get("background-color", "transparent")
@@ -78,6 +66,8 @@ class InputLayout:
             display_list.append(DrawText(self.x, self.y, text, self.font, color))
 
 class LineLayout:
+    __slots__ = ("node", "parent", "previous", "children", "x", "y", "width", "height")
+
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
@@ -99,22 +89,29 @@ class LineLayout:
         if len(self.children) == 0:
             self.height = 0
             return
-        max_ascent = max([-word.font.getMetrics().fAscent for word in self.children])
+        max_ascent = max([-font_metrics(word.font).fAscent for word in self.children])
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline - (-word.font.getMetrics().fAscent)
-        max_descent = max([word.font.getMetrics().fDescent for word in self.children])
+            word.y = baseline - (-font_metrics(word.font).fAscent)
+        max_descent = max([font_metrics(word.font).fDescent for word in self.children])
         self.height = 1.25 * (max_ascent + max_descent)
+
+    def shift(self, dy):
+        self.y += dy
+        for word in self.children:
+            word.shift(dy)
     
     def paint(self, display_list):
         for child in self.children:
             child.paint(display_list)
 
 class TextLayout:
+    __slots__ = ("node", "word", "parent", "previous", "font", "x", "y", "width", "height")
+    children = ()
+
     def __init__(self, node, word, parent, previous):
         self.node = node
         self.word = word
-        self.children = []
         self.parent = parent
         self.previous = previous
     
@@ -125,16 +122,18 @@ class TextLayout:
         if style == "normal": style = "roman"
         size = int(float(self.node.style["font-size"][:-2]) * 0.75)
         self.font = get_font(size, weight, style, family)
-        self.width = self.font.measureText(self.word)
+        self.width = measure_text(self.font, self.word)
 
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = measure_text(self.previous.font, " ")
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
         
-        lineheight = self.font.getMetrics().fDescent - self.font.getMetrics().fAscent
-        self.height = lineheight
+        self.height = line_height(self.font)
+
+    def shift(self, dy):
+        self.y += dy
     
     def paint(self, display_list):
         color = self.node.style["color"]
@@ -145,24 +144,45 @@ class TextLayout:
         display_list.append(DrawText(self.x, self.y, self.word, self.font, color))
 
 class InlineLayout:
+    __slots__ = ("node", "parent", "previous", "children", "x", "y", "width", "height",
+        "cursor_x", "previous_word")
+
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
         self.previous = previous
         self.children = []
+        self.x = None
+        self.y = None
+        self.width = None
 
     def layout(self):
+        old_x, old_width = self.x, self.width
         self.width = self.parent.width
         self.x = self.parent.x
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
+            y = self.parent.y
+        # line breaking depends on everything in the subtree, so any change
+        # in it redoes the whole inline layout, otherwise the lines just move
+        if self.y is not None and not needs_layout(self.node) \
+            and self.x == old_x and self.width == old_width:
+            self.shift(y - self.y)
+            return
+        self.y = y
+        self.children = []
         self.new_line()
         self.recurse(self.node)
         for line in self.children:
             line.layout()
         self.height = sum([line.height for line in self.children])
+        clear_layout_dirty(self.node)
+
+    def shift(self, dy):
+        self.y += dy
+        for line in self.children:
+            line.shift(dy)
     
     def paint(self, display_list):
         bgcolor = "transparent"
@@ -201,7 +221,9 @@ class InlineLayout:
         size = int(float(node.style["font-size"][:-2]) * 0.75)
         font = get_font(size, weight, style, family)
         for word in node.text.split():
-            w = font.measureText(word)
+            # the same words show up over and over in a document, keep one copy of each
+            word = sys.intern(word)
+            w = measure_text(font, word)
             # don't create a new line if the line is empty, but the word still doesn't fit
             if not self.word_fits_line(w) and len(self.children[-1].children) > 0:
                 self.new_line()
@@ -209,7 +231,7 @@ class InlineLayout:
             text = TextLayout(node, word, line, self.previous_word)
             line.children.append(text)
             self.previous_word = text
-            self.cursor_x += w + font.measureText(" ")
+            self.cursor_x += w + measure_text(font, " ")
     
     def get_font(self, node):
         weight = node.style["font-weight"]
@@ -230,7 +252,7 @@ class InlineLayout:
         line.children.append(input)
         self.previous_word = input
         font = self.get_font(node)
-        self.cursor_x += w + font.measureText(" ")
+        self.cursor_x += w + measure_text(font, " ")
     
     def new_line(self):
         self.previous_word = None
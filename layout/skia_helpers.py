@@ -1,4 +1,5 @@
 import skia
+from .fonts import font_metrics, get_scaled_font
 
 scale_factor = None
 
@@ -28,8 +29,8 @@ def draw_line(canvas, x1, y1, x2, y2, width=1):
 def draw_text(canvas, x, y, text, font, color=None):
     sk_color = parse_color(color)
     paint = skia.Paint(AntiAlias=True, Color=sk_color)
-    scaled_font = font.makeWithSize(font.getSize() * scale_factor)
-    canvas.drawString(text, scale_factor * float(x), scale_factor * (y - font.getMetrics().fAscent), scaled_font, paint)
+    scaled_font = get_scaled_font(font, scale_factor)
+    canvas.drawString(text, scale_factor * float(x), scale_factor * (y - font_metrics(font).fAscent), scaled_font, paint)
 
 def draw_rect(canvas, l, t, r, b, fill=None, width=1):
     paint = skia.Paint()
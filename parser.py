@@ -1,4 +1,17 @@
+import re
+
+# characters that can change the state of the tokenizer
+TEXT_DELIMITERS = re.compile(r"[<>]")
+TAG_DELIMITERS = re.compile(r"[<>\"']")
+
+# parsed class attributes by their text, shared between nodes
+MAX_SHARED_CLASS_NAMES = 4096
+SHARED_CLASS_NAMES = {}
+
 class Text:
+    __slots__ = ("text", "children", "parent", "style", "style_dirty", "children_dirty",
+        "layout_dirty", "children_layout_dirty")
+
     def __init__(self, text, parent):
         text = text.replace("&lt;", "<")
         text = text.replace("&gt;", ">")
@@ -6,16 +19,31 @@ class Text:
         self.text = text
         self.children = []
         self.parent = parent
+        self.style = None
+        self.style_dirty = True
+        self.children_dirty = True
+        self.layout_dirty = True
+        self.children_layout_dirty = False
     
     def __repr__(self):
         return repr(self.text)
 
 class Element:
+    __slots__ = ("tag", "children", "parent", "attributes", "style", "style_dirty", "children_dirty",
+        "layout_dirty", "children_layout_dirty", "has_cache")
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.children = []
         self.parent = parent
         self.attributes = attributes
+        self.style = None
+        self.style_dirty = True
+        self.children_dirty = True
+        self.layout_dirty = True
+        self.children_layout_dirty = False
+        # whether some descendant matches, by the key of the :has() argument
+        self.has_cache = None
     
     def __repr__(self):
         attributes = ""
@@ -26,6 +54,184 @@ class Element:
             out += " (attributes: " + attributes + ")"
         return out
 
+def class_names(node):
+    # keyed by the attribute text, so nodes with the same classes share one
+    # set and nothing is stored on the node itself
+    source = node.attributes.get("class", "")
+    names = SHARED_CLASS_NAMES.get(source)
+    if names is None:
+        if len(SHARED_CLASS_NAMES) >= MAX_SHARED_CLASS_NAMES:
+            SHARED_CLASS_NAMES.clear()
+        names = SHARED_CLASS_NAMES[source] = frozenset(source.split())
+    return names
+
+def mark_children_dirty(node):
+    # every ancestor of a node with children_dirty set has it set as well,
+    # so the walk can stop at the first one that already is
+    while node and not node.children_dirty:
+        node.children_dirty = True
+        node = node.parent
+
+def mark_style_dirty(node):
+    node.style_dirty = True
+    mark_children_dirty(node.parent)
+
+def mark_tree_style_dirty(node):
+    # a subtree inserted somewhere else can match different descendant
+    # selectors anywhere in it, not just at its root
+    stack = [node]
+    while stack:
+        descendant = stack.pop()
+        descendant.style_dirty = True
+        descendant.children_dirty = True
+        stack.extend(descendant.children)
+    mark_children_dirty(node.parent)
+
+def mark_has_dirty(node):
+    # the children of node changed, which can change the :has() results of
+    # node and its ancestors. nodes that had results cached are restyled
+    while node:
+        if node.has_cache:
+            node.has_cache = None
+            mark_style_dirty(node)
+        node = node.parent
+
+def mark_layout_dirty(node):
+    node.layout_dirty = True
+    node = node.parent
+    while node and not node.children_layout_dirty:
+        node.children_layout_dirty = True
+        node = node.parent
+
+def needs_layout(node):
+    return node.layout_dirty or node.children_layout_dirty
+
+def clear_layout_dirty(node):
+    node.layout_dirty = False
+    node.children_layout_dirty = False
+    for child in node.children:
+        clear_layout_dirty(child)
+
+# results smaller than this are sorted by their position in the tree instead
+# of numbering the whole document
+MAX_RESULTS_SORTED_BY_POSITION = 32
+
+def tree_position(node):
+    position = []
+    while node.parent:
+        position.append(node.parent.children.index(node))
+        node = node.parent
+    position.reverse()
+    return position
+
+class DOMIndex:
+    # the elements of a document by id, class name and tag. the parser adds
+    # elements as it creates them, scripts changing the tree keep it current
+    def __init__(self):
+        self.by_id = {}
+        self.by_class = {}
+        self.by_tag = {}
+        self.order = None
+
+    def keys(self, node):
+        keys = [("tag", node.tag)]
+        id = node.attributes.get("id")
+        if id:
+            keys.append(("id", id))
+        for className in node.attributes.get("class", "").split():
+            keys.append(("class", className))
+        return keys
+
+    def bucket(self, kind):
+        if kind == "tag":
+            return self.by_tag
+        elif kind == "class":
+            return self.by_class
+        return self.by_id
+
+    def add(self, node):
+        for kind, name in self.keys(node):
+            self.bucket(kind).setdefault(name, set()).add(node)
+        self.order = None
+
+    def remove(self, node):
+        for kind, name in self.keys(node):
+            bucket = self.bucket(kind)
+            nodes = bucket.get(name)
+            if nodes is None: continue
+            nodes.discard(node)
+            if not nodes:
+                del bucket[name]
+        self.order = None
+
+    def contains(self, node):
+        return isinstance(node, Element) and node in self.by_tag.get(node.tag, ())
+
+    def add_tree(self, node):
+        # returns the elements that were added
+        added = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, Element): continue
+            self.add(node)
+            added.append(node)
+            stack.extend(node.children)
+        self.order = None
+        return added
+
+    def remove_tree(self, node):
+        # returns the elements that were removed
+        removed = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, Element): continue
+            self.remove(node)
+            removed.append(node)
+            stack.extend(node.children)
+        self.order = None
+        return removed
+
+    def smallest(self, keys):
+        # the smallest set of elements having one of the keys, every element
+        # matching all of them is in it
+        candidates = None
+        for kind, name in keys:
+            nodes = self.bucket(kind).get(name, ())
+            if candidates is None or len(nodes) < len(candidates):
+                candidates = nodes
+        return candidates
+
+    def in_document_order(self, nodes, root):
+        if len(nodes) <= 1:
+            return list(nodes)
+        if self.order is None and len(nodes) < MAX_RESULTS_SORTED_BY_POSITION:
+            return sorted(nodes, key=tree_position)
+        if self.order is None:
+            self.order = {}
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                self.order[node] = len(self.order)
+                stack.extend(reversed(node.children))
+        return sorted(nodes, key=self.order.__getitem__)
+
+    def element_by_id(self, id, root):
+        nodes = self.by_id.get(id)
+        if not nodes:
+            return None
+        return self.in_document_order(nodes, root)[0]
+
+    def elements_by_class_name(self, names, root):
+        names = names.split()
+        if not names:
+            return []
+        candidates = self.smallest([("class", name) for name in names])
+        names = frozenset(names)
+        nodes = [node for node in candidates if names <= class_names(node)]
+        return self.in_document_order(nodes, root)
+
 class HTMLParser:
     SELF_CLOSING_TAGS = [
         "area", "base", "br", "col", "embed", "hr", "img", "input",
@@ -36,60 +242,114 @@ class HTMLParser:
         "link", "meta", "title", "style", "script",
     ]
 
-    def __init__(self, body):
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        self.in_tag = False
+        self.in_comment = False
+        self.in_script = False
+        self.in_double_quote_attribute = False
+        self.in_single_quote_attribute = False
+        self.index = DOMIndex()
+        self.clear_text()
 
     def parse(self):
-        text = ""
-        in_tag = False
-        in_comment = False
-        in_script = False
-        in_double_quote_attribute = False
-        in_single_quote_attribute = False
-        for c in self.body:
-            in_attribute = in_single_quote_attribute or in_double_quote_attribute
-            if c == "<" and not in_comment and not in_attribute:
-                in_tag = True
-                if text and not in_script: self.add_text(text)
-                text = ""
-            elif c == ">" and not in_comment and not in_attribute:
-                in_tag = False
-                if text == "p" and "p" in [node.tag for node in self.unfinished]:
-                    self.add_tag("/p")
-                if text == "script":
-                    in_script = True
-                if not in_script: self.add_tag(text)
-                elif text == "/script":
-                    in_script = False
-                text = ""
+        self.feed(self.body)
+        return self.close()
+
+    def feed(self, data):
+        # scan for the next character that can change the tokenizer state and
+        # take everything in between in one piece, so the body can arrive in chunks
+        i = 0
+        while i < len(data):
+            in_attribute = self.in_single_quote_attribute or self.in_double_quote_attribute
+            if self.in_tag:
+                match = TAG_DELIMITERS.search(data, i)
+            elif in_attribute:
+                # an attribute that is still open outside of a tag swallows the rest
+                match = None
             else:
-                text += c
-                if in_tag and text == "!--":
-                    in_comment = True
-                if in_comment and text.endswith("-->"):
-                    in_comment = False
-                    in_tag = False
-                    text = ""
-                if in_tag:
-                    if not in_double_quote_attribute and text.endswith("=\""):
-                        in_double_quote_attribute = True
-                    elif in_double_quote_attribute and text.endswith("\"") and not text.endswith("\\\""):
-                        in_double_quote_attribute = False
-                    if not in_single_quote_attribute and text.endswith("='"):
-                        in_single_quote_attribute = True
-                    elif in_single_quote_attribute and text.endswith("'") and not text.endswith("\\'"):
-                        in_single_quote_attribute = False
-        if not in_tag and text and not in_script:
+                match = TEXT_DELIMITERS.search(data, i)
+            if not match:
+                self.append_text(data[i:])
+                break
+            self.append_text(data[i:match.start()])
+            self.consume(data[match.start()])
+            i = match.end()
+
+    def root(self):
+        # the partially parsed tree, open elements included
+        return self.unfinished[0] if self.unfinished else None
+
+    def close(self):
+        text = self.take_text()
+        if not self.in_tag and text and not self.in_script:
             self.add_text(text)
         return self.finish()
-    
+
+    def consume(self, c):
+        in_attribute = self.in_single_quote_attribute or self.in_double_quote_attribute
+        if c == "<" and not self.in_comment and not in_attribute:
+            self.in_tag = True
+            text = self.take_text()
+            if text and not self.in_script: self.add_text(text)
+        elif c == ">" and not self.in_comment and not in_attribute:
+            self.in_tag = False
+            text = self.take_text()
+            if text == "p" and "p" in [node.tag for node in self.unfinished]:
+                self.add_tag("/p")
+            if text == "script":
+                self.in_script = True
+            if not self.in_script: self.add_tag(text)
+            elif text == "/script":
+                self.in_script = False
+        else:
+            previous = self.last_chars
+            self.append_text(c)
+            if self.in_comment and c == ">" and previous == "--":
+                self.in_comment = False
+                self.in_tag = False
+                self.clear_text()
+            if self.in_tag:
+                escaped = previous.endswith("\\")
+                opens = previous.endswith("=")
+                if c == "\"":
+                    if not self.in_double_quote_attribute and opens:
+                        self.in_double_quote_attribute = True
+                    elif self.in_double_quote_attribute and not escaped:
+                        self.in_double_quote_attribute = False
+                elif c == "'":
+                    if not self.in_single_quote_attribute and opens:
+                        self.in_single_quote_attribute = True
+                    elif self.in_single_quote_attribute and not escaped:
+                        self.in_single_quote_attribute = False
+
+    def append_text(self, s):
+        if not s: return
+        self.text.append(s)
+        self.last_chars = (self.last_chars + s[-2:])[-2:]
+        if len(self.text_head) < 3:
+            self.text_head = (self.text_head + s[:3])[:3]
+            if self.in_tag and self.text_head == "!--":
+                self.in_comment = True
+
+    def clear_text(self):
+        self.text = []
+        self.text_head = ""
+        self.last_chars = ""
+
+    def take_text(self):
+        text = "".join(self.text)
+        self.clear_text()
+        return text
+
     def add_text(self, text):
         if text.isspace(): return
         self.implicit_tags(None)
         parent = self.unfinished[-1]
         node = Text(text, parent)
         parent.children.append(node)
+        mark_children_dirty(parent)
     
     def add_tag(self, tag):
         tag, attributes = self.get_attributes(tag)
@@ -97,16 +357,26 @@ class HTMLParser:
         self.implicit_tags(tag)
         if tag.startswith("/"):
             if len(self.unfinished) == 1: return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.unfinished.pop()
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
             parent.children.append(node)
+            mark_children_dirty(parent)
+            mark_has_dirty(parent)
+            self.index.add(node)
         else:
+            # open elements are attached right away, so the tree parsed so far
+            # can be rendered while the rest of the body is still arriving
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
+            if parent:
+                parent.children.append(node)
+                mark_children_dirty(parent)
+                # :has() may have been matched against the tree parsed so
+                # far. only elements can match its argument, text can't
+                mark_has_dirty(parent)
+            self.index.add(node)
             self.unfinished.append(node)
     
     def implicit_tags(self, tag):
@@ -128,9 +398,7 @@ class HTMLParser:
         if len(self.unfinished) == 0:
             self.add_tag("html")
         while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.unfinished.pop()
         return self.unfinished.pop()
     
     def get_attributes(self, text):
@@ -169,10 +437,11 @@ class ViewSourceParser(HTMLParser):
         super().__init__(body)
     
     def parse(self):
-        text = ""
         in_tag = False
-        for c in self.body:
-            if c == "<":
+        i = 0
+        for match in TEXT_DELIMITERS.finditer(self.body):
+            text = self.body[i:match.start()]
+            if match.group() == "<":
                 in_tag = True
                 if text.strip():
                     self.add_tag("pre")
@@ -180,13 +449,11 @@ class ViewSourceParser(HTMLParser):
                     self.add_text(text)
                     self.add_tag("/b")
                     self.add_tag("/pre")
-                text = ""
-            elif c == ">":
+            else:
                 in_tag = False
                 self.add_text("<{}>".format(text))
-                text = ""
-            else:
-                text += c
+            i = match.end()
+        text = self.body[i:]
         if not in_tag and text:
             self.add_text(text)
         return self.finish()
@@ -1,11 +1,15 @@
-import socket
 import ssl
-import gzip
+import zlib
+import codecs
 import cache
+from concurrent.futures import ThreadPoolExecutor
+from connection_pool import CONNECTION_POOL, MAX_CONNECTIONS_PER_HOST
 from helpers import parse_cookie_string, is_cookie_expired, url_origin
 
 MAX_REDIRECTS = 10
 
+fetch_executor = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS_PER_HOST)
+
 COOKIE_JAR = {}
 
 def referrer_header(scheme, host, path, top_level_url, referrer_policy):
@@ -25,17 +29,19 @@ def referrer_header(scheme, host, path, top_level_url, referrer_policy):
         return None
     return None
 
-def build_request(scheme, host, path, top_level_url, payload=None, referrer_policy=None, send_referrer=True):
+def build_request(scheme, host, path, top_level_url, payload=None, referrer_policy=None, send_referrer=True, extra_headers=None):
     method = "POST" if payload else "GET"
     request_headers = {
         "HOST": host,
-        "Connection": "close",
+        "Connection": "keep-alive",
         "User-Agent": "Spacetoaster's Toy Browser",
         "Accept-Encoding": "gzip",
     }
     referrer = referrer_header(scheme, host, path, top_level_url, referrer_policy)
     if referrer and send_referrer:
         request_headers["Referer"] = referrer
+    if extra_headers:
+        request_headers.update(extra_headers)
     body = "{} {} HTTP/1.1\r\n".format(method, path)
     for header, value in request_headers.items():
         body += "{}: {}\r\n".format(header, value)
@@ -58,111 +64,222 @@ def build_request(scheme, host, path, top_level_url, payload=None, referrer_poli
     body += "\r\n" + (payload if payload else "")
     return body.encode("utf8")
 
-def request_http(scheme, url, top_level_url, num_redirects=0, payload=None, referrer_policy=None, send_referrer=True):
+def read_headers(response):
+    headers = {}
+    while True:
+        line = response.readline().decode('utf-8')
+        if line == "\r\n" or line == "":
+            break
+        header, value = line.split(":", 1)
+        headers[header.lower()] = value.strip()
+    return headers
+
+READ_BLOCK_SIZE = 16 * 1024
+
+class BodyDecoder:
+    # incrementally undoes the content encoding and decodes utf-8, so every
+    # piece of the body can be handed to on_data as soon as it arrived
+    def __init__(self, headers, on_data=None):
+        self.decompressor = None
+        if headers.get("content-encoding", "") == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.on_data = on_data
+        self.parts = []
+
+    def write(self, raw):
+        if self.decompressor:
+            raw = self.decompressor.decompress(raw)
+        self.emit(self.decoder.decode(raw))
+
+    def close(self):
+        raw = self.decompressor.flush() if self.decompressor else b""
+        self.emit(self.decoder.decode(raw, final=True))
+        return "".join(self.parts)
+
+    def emit(self, data):
+        if not data: return
+        self.parts.append(data)
+        if self.on_data:
+            self.on_data(data)
+
+def read_chunked_body(response, on_chunk):
+    while True:
+        line = response.readline().decode('utf-8')
+        if line == "":
+            raise ConnectionResetError("connection closed in the middle of a chunked body")
+        if line == "\r\n":
+            continue
+        chunk_size = int(line.split(";", 1)[0], 16)
+        if chunk_size == 0:
+            # skip optional trailers up to the final empty line
+            while response.readline() not in [b"\r\n", b""]:
+                pass
+            break
+        chunk = response.read(chunk_size)
+        if len(chunk) < chunk_size:
+            raise ConnectionResetError("connection closed in the middle of a chunked body")
+        on_chunk(chunk)
+        response.readline()
+
+def read_body(response, status, headers, on_chunk):
+    # passes the raw body to on_chunk piece by piece and returns whether
+    # the framing allows reusing the connection
+    if status.startswith("1") or status in ["204", "304"]:
+        return True
+    if headers.get("transfer-encoding", "") == "chunked":
+        read_chunked_body(response, on_chunk)
+        return True
+    if "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            block = response.read(min(remaining, READ_BLOCK_SIZE))
+            if not block:
+                # a truncated body must not be returned or cached as complete
+                raise ConnectionResetError("connection closed before the end of the body")
+            on_chunk(block)
+            remaining -= len(block)
+        return True
+    # body is delimited by the server closing the connection
+    while True:
+        block = response.read1(READ_BLOCK_SIZE)
+        if not block:
+            return False
+        on_chunk(block)
+
+def discard(block):
+    pass
+
+def keeps_alive(version, headers):
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+def send_request(scheme, host, port, request):
+    # a pooled connection might have been closed by the server in the meantime,
+    # in that case retry once with a fresh connection
+    while True:
+        conn = CONNECTION_POOL.acquire(scheme, host, port)
+        try:
+            conn.send(request)
+            statusline = conn.file.readline().decode('utf-8')
+            if statusline == "":
+                raise ConnectionResetError("connection closed before receiving a response")
+            return conn, statusline
+        except (ConnectionError, ssl.SSLEOFError):
+            CONNECTION_POOL.release(conn, reusable=False)
+            if not conn.reused:
+                raise
+
+def request_http(scheme, url, top_level_url, num_redirects=0, payload=None, referrer_policy=None, send_referrer=True, on_data=None):
     port = 80 if scheme == "http" else 443
     host, path = url.split("/", 1)
     if ":" in host:
         host, port = host.split(":", 1)
         port = int(port)
     path = "/" + path
+    cache_url = "{}://{}".format(scheme, url)
 
-    s = socket.socket(
-        family=socket.AF_INET,
-        type=socket.SOCK_STREAM,
-        proto=socket.IPPROTO_TCP,
-    )
-    if scheme == "https":
-        ctx = ssl.create_default_context()
-        s = ctx.wrap_socket(s, server_hostname=host)
-
+    # ask the server to confirm a stale cached copy instead of sending the full body again
+    validators = cache.conditional_headers(cache_url) if not payload else {}
+    request = build_request(scheme, host, path, top_level_url, payload, referrer_policy, send_referrer, validators)
     try:
-        s.connect((host, port))
+        conn, statusline = send_request(scheme, host, port, request)
     except ssl.SSLError:
         return {}, "SSL Error: preventing connection to {}".format(host)
-    request = build_request(scheme, host, path, top_level_url, payload, referrer_policy, send_referrer)
-    s.send(request)
 
-    response = s.makefile("rb")
-    statusline = response.readline().decode('utf-8')
-    version, status, explanation = statusline.split(" ", 2)
-    headers = {}
-    while True:
-        line = response.readline().decode('utf-8')
-        if line == "\r\n":
-            break
-        header, value = line.split(":", 1)
-        headers[header.lower()] = value.strip()
-    
+    try:
+        version, status, explanation = statusline.split(" ", 2)
+        headers = read_headers(conn.file)
+        # only the body of a successful response is decoded, the others are skipped
+        decoder = BodyDecoder(headers, on_data) if status == "200" else None
+        reusable = read_body(conn.file, status, headers, decoder.write if decoder else discard)
+    except BaseException:
+        CONNECTION_POOL.release(conn, reusable=False)
+        raise
+    CONNECTION_POOL.release(conn, reusable and keeps_alive(version, headers))
+
     if status.startswith("3") and "location" in headers:
         if num_redirects >= MAX_REDIRECTS:
             raise Exception("Maximum number of redirects reached")
-        return handle_redirect(scheme, url, headers["location"], num_redirects + 1)
+        return handle_redirect(scheme, url, headers["location"], num_redirects + 1, on_data)
+
+    if status == "304" and validators:
+        if "set-cookie" in headers:
+            COOKIE_JAR[host] = parse_cookie_string(headers["set-cookie"])
+        response = cache.revalidated_response(cache_url, headers)
+        if response:
+            return response
+        # the entry was evicted in the meantime, request the full response
+        return request_http(scheme, url, top_level_url, num_redirects, payload, referrer_policy, send_referrer, on_data)
 
     assert status == "200", "{}: {}".format(status, explanation)
-    body = ""
-    if "content-encoding" in headers and headers["content-encoding"] == "gzip":
-        if "transfer-encoding" in headers and headers["transfer-encoding"] == "chunked":
-            all_chunks = b''
-            while True:
-                line = response.readline().decode('utf-8')
-                if line == "\r\n":
-                    continue
-                chunkSize = int(line, 16)
-                if chunkSize == 0:
-                    break
-                chunk = response.read(chunkSize)
-                all_chunks += chunk
-            body = gzip.decompress(all_chunks).decode('utf-8')
-        else:
-            body_decompressed = gzip.decompress(response.read())
-            body = body_decompressed.decode('utf-8')
-    else:
-        body = response.read().decode('utf-8')
+    body = decoder.close()
 
-    s.close()
-    cache.try_to_cache("{}://{}".format(scheme, url), headers, body)
+    if not payload:
+        cache.try_to_cache(cache_url, headers, body)
     if "set-cookie" in headers:
         COOKIE_JAR[host] = parse_cookie_string(headers["set-cookie"])
 
     return headers, body
 
-def handle_redirect(scheme, url, location, num_redirects):
+def handle_redirect(scheme, url, location, num_redirects, on_data=None):
     if location.startswith("/"):
-        return request_http(scheme, url + location, url + location, num_redirects)
+        return request_http(scheme, url + location, url + location, num_redirects, on_data=on_data)
     else:
-        return request(location, location, num_redirects)
+        headers, body, _ = request(location, location, num_redirects, on_data=on_data)
+        return headers, body
 
 def request_file(url):
     file = open(url, "r")
     body = file.read()
     return {}, body
 
-def request(url, top_level_url, num_redirects = 0, payload=None, referrer_policy=None, send_referrer=True):
+def request(url, top_level_url, num_redirects = 0, payload=None, referrer_policy=None, send_referrer=True, on_data=None):
+    # on_data receives the decoded body piece by piece while it is downloaded,
+    # bodies that are available all at once are passed to it in one piece
     headers, body = None, None
     view_source = False
     if url.startswith("view-source:"):
         view_source = True
         url = url[len("view-source:"):]
+        on_data = None
+    streamed = False
+    def stream(data):
+        nonlocal streamed
+        streamed = True
+        on_data(data)
     
     method = "POST" if payload else "GET"
 
-    cached_response = cache.get_cached_response(url)
-    if cached_response and method == "GET":
-        return cached_response[0], cached_response[1], view_source
+    if method == "GET":
+        cached_response = cache.get_cached_response(url)
+        if cached_response:
+            if on_data and cached_response[1]:
+                on_data(cached_response[1])
+            return cached_response[0], cached_response[1], view_source
     
     scheme, rest = url.split(":", 1)
     url = rest[2:] if rest.startswith("//") else rest
     assert scheme in ["http", "https", "file",
                       "data"], "Unknown scheme {}".format(scheme)
     if scheme in ["http", "https"]:
-        headers, body = request_http(scheme, url, top_level_url, num_redirects, payload, referrer_policy, send_referrer)
+        headers, body = request_http(scheme, url, top_level_url, num_redirects, payload, referrer_policy, send_referrer,
+            stream if on_data else None)
     elif scheme == "file":
         headers, body = request_file(url)
     elif scheme == "data":
         headers, body = request_data(url)
+    if on_data and not streamed and body:
+        on_data(body)
 
     return headers, body, view_source
 
+def request_async(url, top_level_url, payload=None, referrer_policy=None, send_referrer=True):
+    return fetch_executor.submit(request, url, top_level_url, payload=payload,
+        referrer_policy=referrer_policy, send_referrer=send_referrer)
+
 def request_data(url):
     assert url.startswith("text/html"), "data request not of type text/html"
     media_type, body = url.split(",", 1)
@@ -1,13 +1,61 @@
 console = {
   log: function (x) { call_python("log", x); }
 }
+// DOM mutations are recorded here and sent to python as one array when the
+// task ends or when a read needs them, instead of one call_python each
+DOM_COMMANDS = []
+MAX_DOM_COMMANDS = 1024
+
+// reads are cached until the task ends or a mutation changes them
+ATTRIBUTE_CACHE = {}
+STYLE_CACHE = {}
+CHILDREN_CACHE = {}
+
+// elements created by scripts get their handles here, python's are positive
+NEXT_CREATED_HANDLE = -2
+
+function __recordDOMCommand(command) {
+  DOM_COMMANDS.push(command);
+  if (DOM_COMMANDS.length >= MAX_DOM_COMMANDS) {
+    __flushDOMCommands();
+  }
+}
+
+function __flushDOMCommands() {
+  if (DOM_COMMANDS.length == 0) return;
+  var commands = DOM_COMMANDS;
+  DOM_COMMANDS = [];
+  call_python("applyDOMCommands", commands);
+}
+
+function __endTask() {
+  __flushDOMCommands();
+  ATTRIBUTE_CACHE = {};
+  STYLE_CACHE = {};
+  CHILDREN_CACHE = {};
+}
+
+function __read(name) {
+  __flushDOMCommands();
+  return call_python.apply(null, arguments);
+}
+
 document = { 
   querySelectorAll: function(s) { 
-    var handles = call_python("querySelectorAll", s);
+    var handles = __read("querySelectorAll", s);
+    return handles.map(function(h) { return new Node(h) });
+  },
+  getElementById: function(id) {
+    var handle = __read("getElementById", id);
+    return handle == null ? null : new Node(handle);
+  },
+  getElementsByClassName: function(names) {
+    var handles = __read("getElementsByClassName", names);
     return handles.map(function(h) { return new Node(h) });
   },
   createElement: function(tagName) {
-    var handle = call_python("createElement", tagName)
+    var handle = NEXT_CREATED_HANDLE--;
+    __recordDOMCommand(["createElement", tagName, handle]);
     return new Node(handle)
   },
 }
@@ -26,7 +74,12 @@ LISTENERS = {}
 function Node(handle) { this.handle = handle }
 
 Node.prototype.getAttribute = function(attr) {
-  return call_python("getAttribute", this.handle, attr)
+  var attributes = ATTRIBUTE_CACHE[this.handle];
+  if (!attributes) attributes = ATTRIBUTE_CACHE[this.handle] = {};
+  if (!(attr in attributes)) {
+    attributes[attr] = __read("getAttribute", this.handle, attr);
+  }
+  return attributes[attr];
 }
 
 Node.prototype.addEventListener = function(type, listener) {
@@ -48,16 +101,22 @@ Node.prototype.dispatchEvent = function(evt) {
 }
 
 Node.prototype.appendChild = function(child) {
-  return call_python("appendChild", this.handle, child.handle)
+  CHILDREN_CACHE = {};
+  __recordDOMCommand(["appendChild", this.handle, child.handle]);
+  return child;
 }
 
 Node.prototype.insertBefore = function(newNode, childNode) {
-  childParam = childNode ? childNode.handle : null
-  return call_python("insertBefore", this.handle, newNode.handle, childParam)
+  var childParam = childNode ? childNode.handle : null;
+  CHILDREN_CACHE = {};
+  __recordDOMCommand(["insertBefore", this.handle, newNode.handle, childParam]);
+  return newNode;
 }
 
 Node.prototype.removeChild = function(childNode) {
-  var removedChildHandle = call_python("removeChild", this.handle, childNode.handle)
+  // not batched, it throws if childNode isn't a child
+  CHILDREN_CACHE = {};
+  var removedChildHandle = __read("removeChild", this.handle, childNode.handle);
   return new Node(removedChildHandle)
 }
 
@@ -67,29 +126,32 @@ Node.prototype.getContext = function(_type) {
 
 Object.defineProperty(Node.prototype, 'innerHTML', {
   set: function(s) {
-    call_python("innerHTML_set", this.handle, s.toString());
+    CHILDREN_CACHE = {};
+    __recordDOMCommand(["innerHTML_set", this.handle, s.toString()]);
   },
   get: function() {
-    return call_python("innerHTML_get", this.handle);
+    return __read("innerHTML_get", this.handle);
   }
 })
 
 Object.defineProperty(Node.prototype, 'outerHTML', {
   get: function() {
-    return call_python("outerHTML_get", this.handle);
+    return __read("outerHTML_get", this.handle);
   }
 })
 
 Object.defineProperty(Node.prototype, 'children', {
   get: function(s) {
-    var handles = call_python("children", this.handle)
+    var handles = CHILDREN_CACHE[this.handle];
+    if (!handles) handles = CHILDREN_CACHE[this.handle] = __read("children", this.handle);
     return handles.map(function(h) { return new Node(h) })
   }
 })
 
 Object.defineProperty(Node.prototype, 'style', {
   get: function() {
-    styles = call_python("getStyle", this.handle);
+    var styles = STYLE_CACHE[this.handle];
+    if (!styles) styles = STYLE_CACHE[this.handle] = __read("getStyle", this.handle) || {};
     return new CSSStyleDeclaration(this, styles)
   }
 })
@@ -100,11 +162,11 @@ function CanvasRenderingContext2D(node) {
 }
 
 CanvasRenderingContext2D.prototype.fillRect = function(x, y, w, h) {
-  return call_python("canvas.fillRect", this.node.handle, x, y, w, h, this.fillStyle);
+  __recordDOMCommand(["canvas.fillRect", this.node.handle, x, y, w, h, this.fillStyle]);
 }
 
 CanvasRenderingContext2D.prototype.fillText = function(text, x, y) {
-  return call_python("canvas.fillText", this.node.handle, text, x, y, this.fillStyle);
+  __recordDOMCommand(["canvas.fillText", this.node.handle, text, x, y, this.fillStyle]);
 }
 
 function CSSStyleDeclaration(node, styles) {
@@ -112,12 +174,20 @@ function CSSStyleDeclaration(node, styles) {
   this.styles = styles;
 }
 
+function __setStyle(declaration, property, value) {
+  declaration.styles[property] = value;
+  if (ATTRIBUTE_CACHE[declaration.node.handle]) {
+    delete ATTRIBUTE_CACHE[declaration.node.handle]["style"];
+  }
+  __recordDOMCommand(["setStyle", declaration.node.handle, property, value]);
+}
+
 Object.defineProperty(CSSStyleDeclaration.prototype, 'backgroundColor', {
   get: function() {
     return this.styles["background-color"];
   },
   set: function(value) {
-    call_python("setStyle", this.node.handle, "background-color", value)
+    __setStyle(this, "background-color", value)
   }
 })
 
@@ -126,7 +196,7 @@ Object.defineProperty(CSSStyleDeclaration.prototype, 'fontSize', {
     return this.styles["font-size"];
   },
   set: function(value) {
-    call_python("setStyle", this.node.handle, "font-size", value)
+    __setStyle(this, "font-size", value)
   }
 })
 
@@ -144,35 +214,46 @@ Event.prototype.stopPropagation = function() {
   this.stop_propagation = true;
 }
 
-SET_TIMEOUT_REQUESTS = {}
+// timeouts and intervals share handles, so either can be cleared with
+// clearTimeout or clearInterval
+TIMER_REQUESTS = {}
+NEXT_TIMER_HANDLE = 1
 
 function setTimeout(callback, time_delta) {
-  var handle = Object.keys(SET_TIMEOUT_REQUESTS).length;
-  SET_TIMEOUT_REQUESTS[handle] = callback;
-  call_python("setTimeout", handle, time_delta)
+  var handle = NEXT_TIMER_HANDLE++;
+  TIMER_REQUESTS[handle] = callback;
+  call_python("setTimeout", handle, time_delta);
+  return handle;
 }
 
 function __runSetTimeout(handle) {
-  var callback = SET_TIMEOUT_REQUESTS[handle]
-  callback();
+  var callback = TIMER_REQUESTS[handle];
+  delete TIMER_REQUESTS[handle];
+  if (callback) {
+    callback();
+  }
 }
 
-SET_INTERVAL_REQUESTS = {}
-
 function setInterval(callback, time_delta) {
-  var handle = Object.keys(SET_INTERVAL_REQUESTS).length;
-  SET_INTERVAL_REQUESTS[handle] = callback;
+  var handle = NEXT_TIMER_HANDLE++;
+  TIMER_REQUESTS[handle] = callback;
   call_python("setInterval", handle, time_delta);
   return handle;
 }
 
+function clearTimeout(handle) {
+  if (handle in TIMER_REQUESTS) {
+    delete TIMER_REQUESTS[handle];
+    call_python("clearTimer", handle);
+  }
+}
+
 function clearInterval(handle) {
-  // easy solution: don't clean up the timers
-  delete SET_INTERVAL_REQUESTS[handle];
+  clearTimeout(handle);
 }
 
 function __runSetInterval(handle) {
-  var callback = SET_INTERVAL_REQUESTS[handle]
+  var callback = TIMER_REQUESTS[handle];
   if (callback) {
     callback();
   }
@@ -1,5 +1,10 @@
-from parser import Element
+import hashlib
+import threading
+from parser import Element, mark_layout_dirty, class_names
 from copy import copy
+from heapq import merge
+from collections import OrderedDict
+from types import MappingProxyType
 
 INHERITED_PROPERTIES = {
     "font-family": ".AppleSystemUIFont",
@@ -9,6 +14,49 @@ INHERITED_PROPERTIES = {
     "color": "black",
 }
 
+# computed styles are shared between nodes and must not be modified once
+# computed, a node without declarations of its own reuses the style holding
+# just the properties inherited from its parent
+MAX_SHARED_STYLES = 4096
+SHARED_STYLES = {}
+INHERITED_STYLES = {}
+# parsed style attributes by their text
+INLINE_STYLES = {}
+
+def share_style(style):
+    key = frozenset(style.items())
+    shared = SHARED_STYLES.get(key)
+    if shared is None:
+        if len(SHARED_STYLES) >= MAX_SHARED_STYLES:
+            SHARED_STYLES.clear()
+        SHARED_STYLES[key] = style
+        shared = style
+    return shared
+
+def inherited_style(parent):
+    if parent:
+        values = tuple(parent.style[property] for property in INHERITED_PROPERTIES)
+    else:
+        values = tuple(INHERITED_PROPERTIES.values())
+    style = INHERITED_STYLES.get(values)
+    if style is None:
+        if len(INHERITED_STYLES) >= MAX_SHARED_STYLES:
+            INHERITED_STYLES.clear()
+        style = share_style(dict(zip(INHERITED_PROPERTIES, values)))
+        INHERITED_STYLES[values] = style
+    return style
+
+# parsed selectors by their text, for selectors coming from scripts.
+# selectors keep no state about the documents they are matched against
+MAX_CACHED_SELECTORS = 1024
+SELECTOR_CACHE = {}
+
+# parsed style sheets by a hash of their text, shared by all tabs and
+# evicted least recently used first
+MAX_CACHED_STYLE_SHEETS = 64
+STYLE_SHEET_CACHE = OrderedDict()
+STYLE_SHEET_LOCK = threading.Lock()
+
 def extract_and_add_important_rules(rules, selector, body):
     important = {}
     for prop, val in body.items():
@@ -88,6 +136,8 @@ class CSSParser:
     def tag_or_class_selector(self, tag_or_className):
         if tag_or_className.startswith("."):
             out = ClassSelector(tag_or_className[1:])
+        elif tag_or_className.startswith("#"):
+            out = IdSelector(tag_or_className[1:])
         else:
             out = TagSelector(tag_or_className.lower())
         return out
@@ -147,6 +197,21 @@ class CSSParser:
         
         return rules
 
+def parse_style_sheet(text):
+    # the rules are shared and read-only, a tuple of (selector, body) pairs
+    key = hashlib.sha1(text.encode("utf8")).digest()
+    with STYLE_SHEET_LOCK:
+        rules = STYLE_SHEET_CACHE.get(key)
+        if rules is not None:
+            STYLE_SHEET_CACHE.move_to_end(key)
+            return rules
+    rules = tuple((selector, MappingProxyType(body)) for selector, body in CSSParser(text).parse())
+    with STYLE_SHEET_LOCK:
+        STYLE_SHEET_CACHE[key] = rules
+        while len(STYLE_SHEET_CACHE) > MAX_CACHED_STYLE_SHEETS:
+            STYLE_SHEET_CACHE.popitem(last=False)
+    return rules
+
 def compute_style(node, property, value):
     if property == "font-size":
         if value.endswith("px"):
@@ -177,34 +242,65 @@ def expand_shorthand_properties(node, property, value):
             node.style["font-size"] = compute_style(node, "font-size", values[1])
             node.style["font-family"] = compute_style(node, "font-family", values[2])
 
-def style(node, rules):
-        node.style = {}
-        for property, default_value in INHERITED_PROPERTIES.items():
-            if node.parent:
-                node.style[property] = node.parent.style[property]
-            else:
-                node.style[property] = default_value
-        for selector, body in rules:
-            if not selector.matches(node): continue
-            for property, value in body.items():
-                computed_value = compute_style(node, property, value)
-                if not computed_value: continue
-                node.style[property] = computed_value
-                expand_shorthand_properties(node, property, computed_value)
-        if isinstance(node, Element) and "style" in node.attributes:
-            pairs = CSSParser(node.attributes["style"]).body()
-            for property, value in pairs.items():
-                computed_value = compute_style(node, property, value)
-                if not computed_value: continue
-                node.style[property] = computed_value
-                expand_shorthand_properties(node, property, computed_value)
+def style(node, rules, force=False):
+    # only restyles nodes marked dirty and the descendants of nodes whose
+    # inherited properties changed, force restyles the whole subtree
+    restyle_children = force or node.children_dirty
+    if force or node.style_dirty:
+        old_style = node.style
+        compute_node_style(node, rules)
+        node.style_dirty = False
+        if old_style != node.style:
+            mark_layout_dirty(node)
+        if old_style is None or inherited_properties_changed(old_style, node.style):
+            restyle_children = True
+            force = True
+    node.children_dirty = False
+    if restyle_children:
         for child in node.children:
-            style(child, rules)
+            style(child, rules, force)
+
+def inherited_properties_changed(old_style, new_style):
+    for property in INHERITED_PROPERTIES:
+        if old_style.get(property) != new_style.get(property):
+            return True
+    return False
+
+def compute_node_style(node, rules):
+        inherited = inherited_style(node.parent)
+        node.style = inherited
+        for _, match, body in rules.candidates(node):
+            if not match(node): continue
+            apply_declarations(node, body, inherited)
+        if isinstance(node, Element) and "style" in node.attributes:
+            apply_declarations(node, inline_style(node), inherited)
+        if node.style is not inherited:
+            node.style = share_style(node.style)
+
+def inline_style(node):
+    # the parsed declarations are shared and must not be modified
+    source = node.attributes["style"]
+    body = INLINE_STYLES.get(source)
+    if body is None:
+        if len(INLINE_STYLES) >= MAX_SHARED_STYLES:
+            INLINE_STYLES.clear()
+        body = INLINE_STYLES[source] = CSSParser(source).body()
+    return body
+
+def apply_declarations(node, body, inherited):
+    for property, value in body.items():
+        computed_value = compute_style(node, property, value)
+        if not computed_value: continue
+        if node.style is inherited:
+            node.style = dict(inherited)
+        node.style[property] = computed_value
+        expand_shorthand_properties(node, property, computed_value)
 
 class TagSelector:
     def __init__(self, tag):
         self.tag = tag
         self.priority = 1
+        self.match = None
     
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
@@ -213,6 +309,7 @@ class DescendantSelector:
     def __init__(self):
         self.selectors = []
         self.priority = 0
+        self.match = None
     
     def add_selector(self, selector):
         self.selectors.append(selector)
@@ -228,23 +325,33 @@ class DescendantSelector:
             if selector.matches(node):
                 i -= 1
             node = node.parent
-        return i <= 0
+        return i < 0
 
 class ClassSelector:
     def __init__(self, className):
         self.className = className
         self.priority = 10
+        self.match = None
     
     def matches(self, node):
         if not isinstance(node, Element): return False
-        node_classNames = node.attributes.get("class", "").split()
-        return self.className in node_classNames
+        return self.className in class_names(node)
+
+class IdSelector:
+    def __init__(self, id):
+        self.id = id
+        self.priority = 100
+        self.match = None
+    
+    def matches(self, node):
+        return isinstance(node, Element) and node.attributes.get("id") == self.id
 
 class SelectorSequence:
     def __init__(self, tag_selector, class_selectors):
         self.tag_selector = tag_selector
         self.class_selectors = class_selectors
         self.priority = tag_selector.priority + sum([s.priority for s in self.class_selectors])
+        self.match = None
     
     def matches(self, node):
         if not self.tag_selector.matches(node): return False
@@ -260,36 +367,173 @@ class HasSelector:
         self.base_selector = base_selector
         self.has_selector = has_selector
         self.priority = 20
-        self.has_cache = {}
-        self.cache_initialized = False
-    
-    def build_has_cache_recusively(self, selector, node, root):
-        if selector.matches(node):
-            parent = node.parent
-            while True:
-                if parent in self.has_cache or parent == root:
-                    self.has_cache[parent] = True
-                    break
-                self.has_cache[parent] = True
-                parent = parent.parent
-        for child in node.children:
-            self.build_has_cache_recusively(selector, child, root)
-    
-    def init_cache(self, node):
-        html_tag = node
-        while html_tag.tag != "html":
-            html_tag = html_tag.parent
-        assert html_tag.tag == "html", "html element not found"
-        for child in node.children:
-            self.build_has_cache_recusively(self.has_selector, child, node)
-        self.cache_initialized = True
+        self.match = None
+        self.key = index_key(has_selector)
     
     def matches(self, node):
         if not isinstance(node, Element): return False
-        if not self.cache_initialized:
-            self.init_cache(node)
-        return node in self.has_cache and self.base_selector.matches(node)
+        return self.base_selector.matches(node) and \
+            has_descendant(node, self.key, self.has_selector.matches)
+
+def has_descendant(node, key, match):
+    # the result is cached on node and on the descendants looked at, until
+    # mark_has_dirty clears it for the ancestors of a changed child list
+    cache = node.has_cache
+    if cache is not None and key in cache:
+        return cache[key]
+    found = False
+    for child in node.children:
+        if isinstance(child, Element) and (match(child) or has_descendant(child, key, match)):
+            found = True
+            break
+    if cache is None:
+        cache = node.has_cache = {}
+    cache[key] = found
+    return found
+
+def compile_selector(selector):
+    # a function doing what selector.matches does, checking the rightmost
+    # compound selector first and its tag before its class names
+    if isinstance(selector, TagSelector):
+        tag = selector.tag
+        return lambda node: isinstance(node, Element) and node.tag == tag
+    elif isinstance(selector, ClassSelector):
+        className = selector.className
+        return lambda node: isinstance(node, Element) and className in class_names(node)
+    elif isinstance(selector, IdSelector):
+        id = selector.id
+        return lambda node: isinstance(node, Element) and node.attributes.get("id") == id
+    elif isinstance(selector, SelectorSequence):
+        tag = selector.tag_selector.tag
+        names = frozenset(s.className for s in selector.class_selectors)
+        return lambda node: isinstance(node, Element) and node.tag == tag and names <= class_names(node)
+    elif isinstance(selector, DescendantSelector):
+        if not selector.selectors:
+            return lambda node: False
+        match_last = matcher(selector.selectors[-1])
+        ancestors = [matcher(s) for s in reversed(selector.selectors[:-1])]
+        def match(node):
+            if not match_last(node): return False
+            # matching each ancestor selector against the nearest ancestor it
+            # can match is enough with descendant combinators only
+            node = node.parent
+            for match_ancestor in ancestors:
+                while node and not match_ancestor(node):
+                    node = node.parent
+                if not node: return False
+                node = node.parent
+            return True
+        return match
+    elif isinstance(selector, HasSelector):
+        match_base = matcher(selector.base_selector)
+        match_descendant = matcher(selector.has_selector)
+        key = selector.key
+        return lambda node: match_base(node) and has_descendant(node, key, match_descendant)
+    return selector.matches
+
+def matcher(selector):
+    if selector.match is None:
+        selector.match = compile_selector(selector)
+    return selector.match
+
+def parse_selector(text):
+    selector = SELECTOR_CACHE.get(text)
+    if selector is None:
+        selector = CSSParser(text).selector()
+        if len(SELECTOR_CACHE) >= MAX_CACHED_SELECTORS:
+            SELECTOR_CACHE.clear()
+        SELECTOR_CACHE[text] = selector
+    return selector
+
+def selector_keys(selector):
+    # (kind, name) pairs of a DOMIndex that every matching element has
+    if isinstance(selector, TagSelector):
+        return [("tag", selector.tag)]
+    elif isinstance(selector, ClassSelector):
+        return [("class", selector.className)]
+    elif isinstance(selector, IdSelector):
+        return [("id", selector.id)]
+    elif isinstance(selector, SelectorSequence):
+        keys = selector_keys(selector.tag_selector)
+        for class_selector in selector.class_selectors:
+            keys += selector_keys(class_selector)
+        return keys
+    elif isinstance(selector, DescendantSelector):
+        if not selector.selectors:
+            return []
+        return selector_keys(selector.selectors[-1])
+    elif isinstance(selector, HasSelector):
+        return selector_keys(selector.base_selector)
+    return []
 
 def cascade_priority(rule):
     selector, body = rule
-    return selector.priority
\ No newline at end of file
+    return selector.priority
+
+def index_key(selector):
+    # the part of the rightmost compound selector a node has to have for the rule to match
+    if isinstance(selector, TagSelector):
+        return ("tag", selector.tag)
+    elif isinstance(selector, ClassSelector):
+        return ("class", selector.className)
+    elif isinstance(selector, IdSelector):
+        return ("id", selector.id)
+    elif isinstance(selector, SelectorSequence):
+        if selector.class_selectors:
+            return index_key(selector.class_selectors[0])
+        return index_key(selector.tag_selector)
+    elif isinstance(selector, DescendantSelector):
+        if not selector.selectors:
+            return None
+        return index_key(selector.selectors[-1])
+    elif isinstance(selector, HasSelector):
+        return index_key(selector.base_selector)
+    return ("universal", None)
+
+class RuleIndex:
+    # buckets the rules by tag, class name and id, so each node is only matched
+    # against rules that can apply to it, in cascade priority order
+    def __init__(self, rules):
+        self.rules = rules
+        self.size = len(rules)
+        self.by_tag = {}
+        self.by_class = {}
+        self.by_id = {}
+        self.universal = []
+        for order, (selector, body) in enumerate(sorted(rules, key=cascade_priority)):
+            key = index_key(selector)
+            if not key:
+                continue
+            kind, name = key
+            entry = (order, matcher(selector), body)
+            if kind == "tag":
+                self.by_tag.setdefault(name, []).append(entry)
+            elif kind == "class":
+                self.by_class.setdefault(name, []).append(entry)
+            elif kind == "id":
+                self.by_id.setdefault(name, []).append(entry)
+            else:
+                self.universal.append(entry)
+
+    def indexes(self, rules):
+        return self.rules is rules and self.size == len(rules)
+
+    def candidates(self, node):
+        if not isinstance(node, Element):
+            return self.universal
+        buckets = []
+        if node.tag in self.by_tag:
+            buckets.append(self.by_tag[node.tag])
+        for className in class_names(node):
+            if className in self.by_class:
+                buckets.append(self.by_class[className])
+        id = node.attributes.get("id")
+        if id in self.by_id:
+            buckets.append(self.by_id[id])
+        if self.universal:
+            buckets.append(self.universal)
+        if not buckets:
+            return []
+        if len(buckets) == 1:
+            return buckets[0]
+        return merge(*buckets)
\ No newline at end of file
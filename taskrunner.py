@@ -1,43 +1,92 @@
 import threading
+import time
+from collections import deque
+
+# task priorities, lower runs first. the scripts of a page run in document
+# order before anything else, like they would while the page is parsed
+SCRIPT_PRIORITY = 0
+INPUT_PRIORITY = 1
+RENDERING_PRIORITY = 2
+TIMER_PRIORITY = 3
+NETWORK_PRIORITY = 4
+PRIORITY_NAMES = ["scripts", "input", "rendering", "timers", "network"]
+
+# after running tasks for this long without going idle, the task that has
+# waited the longest runs next, whatever its priority
+TASK_SLICE_SEC = 0.05
 
 class Task:
     def __init__(self, task_code, *args):
         self.task_code = task_code
         self.args = args
         self.__name__ = "task"
-    
+        self.scheduled_at = None
+
     def run(self):
         self.task_code(*self.args)
         self.task_code = None
         self.args = None
 
+class QueueStats:
+    def __init__(self):
+        self.count = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def add(self, latency):
+        self.count += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
 class TaskRunner:
     def __init__(self):
-        self.tasks = []
+        self.queues = [deque() for _ in PRIORITY_NAMES]
+        self.stats = [QueueStats() for _ in PRIORITY_NAMES]
         self.condition = threading.Condition()
+        self.slice_start = None
         self.main_thread = threading.Thread(target=self.run)
-    
+
     def start(self):
         self.main_thread.start()
 
-    def schedule_task(self, task):
-        self.condition.acquire(blocking=True)
-        self.tasks.append(task)
-        self.condition.notify_all()
-        self.condition.release()
-    
+    def schedule_task(self, task, priority=INPUT_PRIORITY):
+        with self.condition:
+            task.scheduled_at = time.monotonic()
+            self.queues[priority].append(task)
+            self.condition.notify_all()
+
+    def next_task(self, now):
+        # called with the condition held and at least one task queued
+        if self.queues[SCRIPT_PRIORITY]:
+            priority = SCRIPT_PRIORITY
+        elif now - self.slice_start > TASK_SLICE_SEC:
+            # starvation protection, higher priority work had a whole slice
+            self.slice_start = now
+            queue = min((queue for queue in self.queues if queue), key=lambda queue: queue[0].scheduled_at)
+            priority = self.queues.index(queue)
+        else:
+            priority = next(i for i, queue in enumerate(self.queues) if queue)
+        task = self.queues[priority].popleft()
+        self.stats[priority].add(now - task.scheduled_at)
+        return task
+
     def run(self):
         while True:
-            self.condition.acquire(blocking=True)
-            task = None
-            if len(self.tasks) > 0:
-                task = self.tasks.pop(0)
-            self.condition.release()
-            if task:
-                # print("running task")
-                task.run()
-            
-            self.condition.acquire(blocking=True)
-            if len(self.tasks) == 0:
-                self.condition.wait()
-            self.condition.release()
\ No newline at end of file
+            with self.condition:
+                while not any(self.queues):
+                    self.slice_start = None
+                    self.condition.wait()
+                now = time.monotonic()
+                if self.slice_start is None:
+                    self.slice_start = now
+                task = self.next_task(now)
+            task.run()
+
+    def text(self):
+        with self.condition:
+            lines = []
+            for name, stats in zip(PRIORITY_NAMES, self.stats):
+                if stats.count == 0: continue
+                lines.append("{} tasks: {}, queueing latency {:.1f}ms average, {:.1f}ms max".format(
+                    name, stats.count, stats.total_latency / stats.count * 1000, stats.max_latency * 1000))
+            return "\n".join(lines)
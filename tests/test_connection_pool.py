@@ -0,0 +1,94 @@
+import socket
+import threading
+import time
+from connection_pool import ConnectionPool
+
+class Server:
+    # accepts connections on localhost and keeps them open until stopped,
+    # like server.py does for keep-alive clients
+    def __init__(self):
+        self.socket = socket.socket()
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen()
+        self.port = self.socket.getsockname()[1]
+        self.accepted = []
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                return
+            self.accepted.append(conn)
+
+    def close_clients(self):
+        for conn in self.accepted:
+            conn.close()
+
+    def stop(self):
+        self.close_clients()
+        self.socket.close()
+
+def test_released_connection_is_reused():
+    server = Server()
+    pool = ConnectionPool()
+    conn = pool.acquire("http", "127.0.0.1", server.port)
+    pool.release(conn, reusable=True)
+    again = pool.acquire("http", "127.0.0.1", server.port)
+    assert again is conn and again.reused
+    pool.release(again, reusable=True)
+    pool.close_all()
+    server.stop()
+
+def test_idle_connection_expires():
+    server = Server()
+    pool = ConnectionPool(idle_timeout=0.05)
+    conn = pool.acquire("http", "127.0.0.1", server.port)
+    pool.release(conn, reusable=True)
+    time.sleep(0.1)
+    again = pool.acquire("http", "127.0.0.1", server.port)
+    assert again is not conn and not again.reused
+    pool.release(again, reusable=False)
+    server.stop()
+
+def test_connection_closed_by_server_is_not_reused():
+    server = Server()
+    pool = ConnectionPool()
+    conn = pool.acquire("http", "127.0.0.1", server.port)
+    pool.release(conn, reusable=True)
+    time.sleep(0.05)
+    server.close_clients()
+    time.sleep(0.05)
+    again = pool.acquire("http", "127.0.0.1", server.port)
+    assert again is not conn
+    pool.release(again, reusable=False)
+    server.stop()
+
+def test_per_host_limit_waits_for_release():
+    server = Server()
+    pool = ConnectionPool(max_per_host=2)
+    first = pool.acquire("http", "127.0.0.1", server.port)
+    second = pool.acquire("http", "127.0.0.1", server.port)
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire("http", "127.0.0.1", server.port)))
+    thread.start()
+    time.sleep(0.1)
+    assert not acquired
+    pool.release(first, reusable=True)
+    thread.join(1)
+    assert acquired == [first]
+    pool.release(second, reusable=False)
+    pool.release(first, reusable=False)
+    server.stop()
+
+def test_leaked_connection_does_not_block_forever():
+    server = Server()
+    pool = ConnectionPool(max_per_host=1)
+    pool.acquire("http", "127.0.0.1", server.port)
+    start = time.monotonic()
+    conn = pool.acquire("http", "127.0.0.1", server.port, timeout=0.1)
+    assert time.monotonic() - start >= 0.1
+    assert pool.active[conn.key] == 2
+    pool.release(conn, reusable=False)
+    server.stop()
@@ -0,0 +1,52 @@
+import os
+from disk_cache import DiskCache, INDEX_FILE, JOURNAL_FILE, MAX_JOURNAL_RECORDS
+from cache import HTTPCache
+
+def test_store_appends_to_journal_instead_of_rewriting_index(tmp_path):
+    disk = DiskCache(str(tmp_path))
+    disk.store("http://a/1", {"etag": "x"}, "one", 100)
+    disk.store("http://a/2", {}, "two", 100)
+    assert not os.path.exists(tmp_path / INDEX_FILE)
+    assert len(open(tmp_path / JOURNAL_FILE).readlines()) >= 2
+    reopened = DiskCache(str(tmp_path))
+    assert reopened.load("http://a/1")[1] == "one"
+    assert reopened.load("http://a/2")[1] == "two"
+
+def test_journal_is_folded_into_index(tmp_path):
+    disk = DiskCache(str(tmp_path))
+    for i in range(MAX_JOURNAL_RECORDS + 1):
+        disk.update("http://a/missing", {}, 0)
+        disk.store("http://a/{}".format(i % 10), {}, "body", 100)
+    assert os.path.exists(tmp_path / INDEX_FILE)
+    assert len(open(tmp_path / JOURNAL_FILE).readlines()) < MAX_JOURNAL_RECORDS
+    disk.close()
+    assert open(tmp_path / JOURNAL_FILE).read() == ""
+    assert len(DiskCache(str(tmp_path)).index) == 10
+
+def test_torn_journal_line_is_ignored(tmp_path):
+    disk = DiskCache(str(tmp_path))
+    disk.store("http://a/1", {}, "one", 100)
+    disk.delete("http://a/1")
+    disk.store("http://a/2", {}, "two", 100)
+    with open(tmp_path / JOURNAL_FILE, "a") as f:
+        f.write('{"url": "http://a/3", "rec')
+    reopened = DiskCache(str(tmp_path))
+    assert list(reopened.index) == ["http://a/2"]
+
+def test_clear_removes_disk_entries(tmp_path):
+    cache = HTTPCache()
+    cache.enable_disk_cache(str(tmp_path))
+    cache.disk.store("http://a/1", {}, "one", 100)
+    cache.clear()
+    assert cache.disk.load("http://a/1") is None
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".body")]
+    assert DiskCache(str(tmp_path)).index == {}
+
+def test_uncacheable_response_replaces_stored_entry(tmp_path):
+    cache = HTTPCache()
+    cache.enable_disk_cache(str(tmp_path))
+    cache.store("http://a/1", {"cache-control": "max-age=600", "etag": "\"v1\""}, "one")
+    cache.store("http://a/1", {"cache-control": "max-age=0"}, "two")
+    assert cache.lookup("http://a/1") is None
+    assert cache.conditional_headers("http://a/1") == {}
+    assert cache.disk.load("http://a/1") is None
@@ -0,0 +1,13 @@
+from layout import fonts
+
+def test_font_caches_are_bounded(monkeypatch):
+    monkeypatch.setattr(fonts, "MAX_CACHED_FONTS", 4)
+    manager = fonts.FontManager()
+    first = manager.font(10, "normal", "roman")
+    for size in range(11, 20):
+        manager.scaled_font(manager.font(size, "normal", "roman"), 2)
+        # the first font is used all along and stays cached
+        assert manager.font(10, "normal", "roman") is first
+    assert len(manager.fonts) == 4
+    assert len(manager.scaled_fonts) == 4
+    assert len(manager.typefaces) == 1
@@ -0,0 +1,72 @@
+import dukpy
+import pytest
+from parser import HTMLParser
+from taskrunner import TaskRunner
+from timers import TimerQueue
+from js_context import JSContext
+from style import CSSParser, RuleIndex, style
+
+class FakeTab:
+    def __init__(self, body):
+        parser = HTMLParser(body)
+        self.nodes = parser.parse()
+        self.dom_index = parser.index
+        self.task_runner = TaskRunner()
+        self.timers = TimerQueue()
+        self.url = "http://test/"
+        self.document = None
+
+    def set_needs_render(self):
+        pass
+
+def make_context(body):
+    tab = FakeTab(body)
+    return tab, JSContext(tab)
+
+def test_failing_command_does_not_drop_later_ones():
+    tab, js = make_context("<html><body><div id=a></div><div id=b></div></body></html>")
+    js.run("""
+        var a = document.getElementById('a');
+        a.insertBefore(document.createElement('span'), new Node(12345));
+        a.appendChild(document.createElement('p'));
+    """)
+    assert js.run("document.querySelectorAll('p').length") == 1
+
+def test_remove_child_returns_removed_node():
+    tab, js = make_context("<html><body><div id=a><p id=c></p></div></body></html>")
+    assert js.run("""
+        var a = document.getElementById('a');
+        var removed = a.removeChild(document.getElementById('c'));
+        removed.getAttribute('id') + document.querySelectorAll('p').length;
+    """) == "c0"
+
+def test_remove_child_throws_for_non_child():
+    tab, js = make_context("<html><body><div id=a></div><p id=c></p></body></html>")
+    with pytest.raises(dukpy.JSRuntimeError):
+        js.run("document.getElementById('a').removeChild(document.getElementById('c'))")
+    assert js.run("document.querySelectorAll('p').length") == 1
+
+def test_node_moved_under_detached_parent_leaves_index():
+    tab, js = make_context("<html><body><div id=a><p id=c class=x></p></div></body></html>")
+    js.run("""
+        var holder = document.createElement('div');
+        holder.appendChild(document.getElementById('c'));
+    """)
+    assert js.run("document.querySelectorAll('.x').length") == 0
+    assert js.run("document.getElementById('c') === null") is True
+    assert js.run("document.getElementById('a').children.length") == 0
+    js.run("""
+        var p = holder.children[0];
+        document.getElementById('a').insertBefore(p, null);
+    """)
+    assert js.run("document.querySelectorAll('.x').length") == 1
+    assert js.run("document.getElementById('c').getAttribute('id')") == "c"
+
+def test_moved_subtree_is_restyled_for_descendant_selectors():
+    tab, js = make_context("<html><body><div class=hot></div><div id=m><p id=c>x</p></div></body></html>")
+    rules = RuleIndex(CSSParser(".hot p { background-color: red; }").parse())
+    style(tab.nodes, rules, True)
+    js.run("document.querySelectorAll('.hot')[0].appendChild(document.getElementById('m'))")
+    style(tab.nodes, rules)
+    p = tab.dom_index.element_by_id("c", tab.nodes)
+    assert p.style.get("background-color") == "red"
@@ -0,0 +1,144 @@
+import gzip
+import socket
+import threading
+import pytest
+import cache
+from connection_pool import CONNECTION_POOL
+from request import request_http
+
+CLOSE = object()
+
+class ScriptedServer:
+    # answers the requests it receives with the raw responses it was given,
+    # in order, on whatever connection they arrive. CLOSE closes the
+    # connection instead of answering
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.connections = 0
+        self.paths = []
+        self.lock = threading.Lock()
+        self.socket = socket.socket()
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen()
+        self.port = self.socket.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connections += 1
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        file = conn.makefile("rb")
+        while True:
+            line = file.readline()
+            if not line:
+                break
+            while file.readline() not in [b"\r\n", b""]:
+                pass
+            with self.lock:
+                self.paths.append(line.split()[1].decode("utf8"))
+                response = self.responses.pop(0)
+            if response is CLOSE:
+                break
+            conn.sendall(response)
+            if b"connection: close" in response.lower() or \
+                    (b"HTTP/1.0" in response and b"keep-alive" not in response.lower()):
+                break
+            if b"content-length" not in response.lower() and b"chunked" not in response.lower():
+                break
+        file.close()
+        conn.close()
+
+    def url(self, path):
+        return "127.0.0.1:{}{}".format(self.port, path)
+
+    def stop(self):
+        self.socket.close()
+        CONNECTION_POOL.close_all()
+
+def response(body, version="HTTP/1.1", headers=()):
+    head = "{} 200 OK\r\nCache-Control: no-store\r\n".format(version)
+    for header in headers:
+        head += header + "\r\n"
+    return head.encode("utf8") + b"\r\n" + body
+
+def with_length(body, version="HTTP/1.1", headers=()):
+    return response(body, version, ("Content-Length: {}".format(len(body)),) + tuple(headers))
+
+def test_framings_share_one_connection():
+    zipped = gzip.compress(b"compressed body")
+    server = ScriptedServer([
+        with_length(b"hello"),
+        response(b"4\r\nchun\r\n3;ext=1\r\nked\r\n0\r\nExpires: never\r\n\r\n",
+            headers=("Transfer-Encoding: chunked",)),
+        with_length(zipped, headers=("Content-Encoding: gzip",)),
+        with_length(b""),
+    ])
+    assert request_http("http", server.url("/length"), None)[1] == "hello"
+    assert request_http("http", server.url("/chunked"), None)[1] == "chunked"
+    assert request_http("http", server.url("/gzip"), None)[1] == "compressed body"
+    assert request_http("http", server.url("/empty"), None)[1] == ""
+    assert server.connections == 1
+    server.stop()
+
+def test_connection_close_retires_connection():
+    server = ScriptedServer([
+        with_length(b"one", headers=("Connection: close",)),
+        with_length(b"two"),
+    ])
+    assert request_http("http", server.url("/one"), None)[1] == "one"
+    assert request_http("http", server.url("/two"), None)[1] == "two"
+    assert server.connections == 2
+    server.stop()
+
+def test_http_1_0_keeps_alive_only_when_asked():
+    server = ScriptedServer([
+        with_length(b"one", "HTTP/1.0"),
+        with_length(b"two", "HTTP/1.0", ("Connection: keep-alive",)),
+        with_length(b"three", "HTTP/1.0", ("Connection: keep-alive",)),
+    ])
+    assert request_http("http", server.url("/one"), None)[1] == "one"
+    assert request_http("http", server.url("/two"), None)[1] == "two"
+    assert request_http("http", server.url("/three"), None)[1] == "three"
+    assert server.connections == 2
+    server.stop()
+
+def test_body_delimited_by_close_retires_connection():
+    server = ScriptedServer([
+        response(b"until the end"),
+        with_length(b"next"),
+    ])
+    assert request_http("http", server.url("/close"), None)[1] == "until the end"
+    assert request_http("http", server.url("/next"), None)[1] == "next"
+    assert server.connections == 2
+    server.stop()
+
+def test_reused_connection_closed_by_server_is_retried():
+    server = ScriptedServer([
+        with_length(b"one"),
+        CLOSE,
+        with_length(b"two"),
+    ])
+    assert request_http("http", server.url("/one"), None)[1] == "one"
+    assert request_http("http", server.url("/two"), None)[1] == "two"
+    assert server.paths == ["/one", "/two", "/two"]
+    assert server.connections == 2
+    server.stop()
+
+def test_truncated_bodies_raise_and_are_not_cached():
+    server = ScriptedServer([
+        b"HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\nContent-Length: 100\r\nConnection: close\r\n\r\nshort",
+        b"HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\nTransfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n10\r\nshort",
+    ])
+    for path in ["/length", "/chunked"]:
+        with pytest.raises(ConnectionResetError):
+            request_http("http", server.url(path), None)
+        assert cache.get_cached_response("http://" + server.url(path)) is None
+    server.stop()
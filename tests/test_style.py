@@ -0,0 +1,27 @@
+from parser import HTMLParser, Element
+from style import CSSParser, RuleIndex, style
+
+def find(node, tag):
+    if isinstance(node, Element) and node.tag == tag:
+        return node
+    for child in node.children:
+        found = find(child, tag)
+        if found:
+            return found
+
+def test_has_sees_elements_parsed_after_progressive_style():
+    rules = RuleIndex(CSSParser("div:has(p) { color: red; }").parse())
+    parser = HTMLParser()
+    parser.feed("<html><body><div><span>a</span>")
+    style(parser.root(), rules)
+    assert find(parser.root(), "div").style["color"] == "black"
+    parser.feed("<p>late</p></div></body></html>")
+    root = parser.close()
+    style(root, rules)
+    assert find(root, "div").style["color"] == "red"
+
+def test_has_matches_fresh_parse():
+    rules = RuleIndex(CSSParser("div:has(p) { color: red; }").parse())
+    root = HTMLParser("<html><body><div><span>a</span><p>late</p></div></body></html>").parse()
+    style(root, rules)
+    assert find(root, "div").style["color"] == "red"
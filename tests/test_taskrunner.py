@@ -0,0 +1,17 @@
+from taskrunner import TaskRunner, Task, SCRIPT_PRIORITY, INPUT_PRIORITY, RENDERING_PRIORITY, TASK_SLICE_SEC
+
+def order(runner, now):
+    names = []
+    while any(runner.queues):
+        names.append(runner.next_task(now).args[0])
+    return names
+
+def test_scripts_run_before_input_and_rendering():
+    runner = TaskRunner()
+    runner.schedule_task(Task(print, "click"), INPUT_PRIORITY)
+    runner.schedule_task(Task(print, "frame"), RENDERING_PRIORITY)
+    runner.schedule_task(Task(print, "a.js"), SCRIPT_PRIORITY)
+    runner.schedule_task(Task(print, "b.js"), SCRIPT_PRIORITY)
+    runner.slice_start = 0
+    # a slice is long over, the scripts still run first and in order
+    assert order(runner, TASK_SLICE_SEC * 10) == ["a.js", "b.js", "click", "frame"]
@@ -0,0 +1,15 @@
+from constants import TILE_SIZE
+from tiles import TileCache
+
+def test_tile_rastered_after_retain_is_dropped():
+    tiles = TileCache(1)
+    tiles.set_display_list([])
+    inside, outside = (0, 0), (0, 10)
+    for key in [inside, outside]:
+        tiles.pending[key] = tiles.fingerprint(key)
+    tiles.retain(0, TILE_SIZE * 2)
+    # the raster jobs started before retain finish afterwards
+    for key in [inside, outside]:
+        tiles.raster_job(key, tiles.fingerprint(key), tiles.items(key))
+    assert inside in tiles.tiles
+    assert outside not in tiles.tiles
@@ -0,0 +1,45 @@
+import threading
+import time
+from timers import TimerQueue
+
+class SlowReleaseLock:
+    # gives other threads time to run between the timer thread releasing
+    # the lock and whatever it does next
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self.lock.acquire(blocking, timeout)
+
+    def release(self):
+        self.lock.release()
+        if threading.current_thread() is not threading.main_thread():
+            time.sleep(0.05)
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+def test_no_callback_after_clear_returns():
+    timers = TimerQueue()
+    timers.condition = threading.Condition(SlowReleaseLock())
+    state = {"cleared": False}
+    fired = []
+    timers.add("t", 0, lambda: fired.append(state["cleared"]))
+    time.sleep(0.02)
+    timers.clear()
+    state["cleared"] = True
+    time.sleep(0.1)
+    assert True not in fired
+
+def test_interval_fires_until_cancelled():
+    timers = TimerQueue()
+    ticks = []
+    timers.add("tick", 0.01, lambda: ticks.append(1), 0.01)
+    time.sleep(0.1)
+    timers.cancel("tick")
+    count = len(ticks)
+    time.sleep(0.05)
+    assert count > 3 and len(ticks) == count
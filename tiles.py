@@ -0,0 +1,155 @@
+import math
+import os
+import threading
+import skia
+from concurrent.futures import ThreadPoolExecutor
+from constants import WIDTH, TILE_SIZE
+from layout.drawing import DisplayListIndex, execute_culled
+from compositor import Compositor
+
+COLUMNS = math.ceil(WIDTH / TILE_SIZE)
+RASTER_THREADS = os.cpu_count() or 1
+
+raster_workers = ThreadPoolExecutor(RASTER_THREADS)
+
+def tile_range(start, end):
+    return range(math.floor(start / TILE_SIZE), math.floor(end / TILE_SIZE) + 1)
+
+def tile_rect(key):
+    column, row = key
+    return skia.Rect.MakeXYWH(column * TILE_SIZE, row * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+
+class Tile:
+    def __init__(self, fingerprint, image):
+        self.fingerprint = fingerprint
+        self.image = image
+
+class TileCache:
+    # the tab is rastered in TILE_SIZE x TILE_SIZE tiles in page coordinates,
+    # a tile is rastered again only if the commands that intersect it changed.
+    # tiles are rastered on the raster workers, the browser thread only
+    # draws tiles that are done and is told when more are ready
+    def __init__(self, scale, on_tile_ready=None):
+        self.scale = scale
+        self.on_tile_ready = on_tile_ready
+        self.tiles = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.display_list = None
+        self.index = DisplayListIndex([])
+        self.compositor = Compositor(scale)
+        self.tile_items = {}
+        self.fingerprints = {}
+        # tiles whose image changed since the browser last drew
+        self.damaged = set()
+        self.rastered = 0
+        self.reused = 0
+
+    def set_display_list(self, display_list):
+        # the index is built once per commit, tiles look up their commands in it
+        self.display_list = display_list
+        self.index = DisplayListIndex(display_list or [])
+        self.compositor.commit(self.index.items)
+        self.tile_items = {}
+        self.fingerprints = {}
+
+    def items(self, key):
+        items = self.tile_items.get(key)
+        if items is None:
+            items = self.index.query(tile_rect(key))
+            self.tile_items[key] = items
+        return items
+
+    def fingerprint(self, key):
+        fingerprint = self.fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = tuple(item.signature() for item in self.items(key))
+            self.fingerprints[key] = fingerprint
+        return fingerprint
+
+    def raster_tile(self, key, items):
+        column, row = key
+        size = TILE_SIZE * self.scale
+        surface = skia.Surface(size, size)
+        canvas = surface.getCanvas()
+        canvas.clear(skia.ColorWHITE)
+        canvas.translate(-column * size, -row * size)
+        rect = tile_rect(key)
+        for item in items:
+            self.compositor.draw(item, canvas, rect, execute_culled)
+        return surface.makeImageSnapshot()
+
+    def raster_job(self, key, fingerprint, items):
+        try:
+            image = self.raster_tile(key, items)
+        except Exception as e:
+            print("raster of tile {} failed: {}".format(key, e))
+            return
+        with self.lock:
+            # a newer commit may have changed the tile while it was rastered
+            if self.pending.get(key) != fingerprint:
+                return
+            del self.pending[key]
+            self.tiles[key] = Tile(fingerprint, image)
+            self.damaged.add(key)
+            self.rastered += 1
+        if self.on_tile_ready:
+            self.on_tile_ready()
+
+    def schedule(self, key):
+        fingerprint = self.fingerprint(key)
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile and tile.fingerprint == fingerprint:
+                self.reused += 1
+                return
+            if self.pending.get(key) == fingerprint:
+                return
+            self.pending[key] = fingerprint
+        raster_workers.submit(self.raster_job, key, fingerprint, self.items(key))
+
+    def keys(self, top, bottom):
+        return [(column, row) for row in tile_range(top, bottom - 1) for column in range(COLUMNS)]
+
+    def raster(self, top, bottom, region_top, region_bottom):
+        # tiles in the viewport are queued first, then the rest of the
+        # interest region so that scrolling finds them done
+        visible = self.keys(top, bottom)
+        for key in visible:
+            self.schedule(key)
+        for key in self.keys(region_top, region_bottom):
+            if key not in visible:
+                self.schedule(key)
+
+    def draw(self, canvas, top, bottom):
+        # draws the tiles covering page coordinates top to bottom, with the
+        # canvas translated so that page coordinates map to device pixels.
+        # a tile that is being rastered again is drawn with its old image
+        size = TILE_SIZE * self.scale
+        with self.lock:
+            tiles = [(key, self.tiles.get(key)) for key in self.keys(top, bottom)]
+        for (column, row), tile in tiles:
+            if tile:
+                canvas.drawImage(tile.image, column * size, row * size)
+
+    def take_damage(self):
+        with self.lock:
+            damaged = self.damaged
+            self.damaged = set()
+        return damaged
+
+    def retain(self, top, bottom):
+        # tiles outside the interest region are dropped. so are the ones
+        # still being rastered, raster_job discards them when they finish
+        rows = tile_range(top, bottom)
+        with self.lock:
+            for key in list(self.tiles):
+                if key[1] not in rows:
+                    del self.tiles[key]
+            for key in list(self.pending):
+                if key[1] not in rows:
+                    del self.pending[key]
+
+    def text(self):
+        return "Tiles: {} rastered, {} reused, {} cached\n{}".format(
+            self.rastered, self.reused, len(self.tiles), self.compositor.text())
@@ -0,0 +1,88 @@
+import heapq
+import math
+import threading
+import time
+
+class Timer:
+    def __init__(self, key, deadline, callback, interval):
+        self.key = key
+        self.deadline = deadline
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+class TimerQueue:
+    # all timers of a tab share one thread that sleeps until the earliest
+    # deadline in a heap. cancelled timers stay in the heap until they come up.
+    # callbacks run on the timer thread with the lock held, so a timer never
+    # fires once cancel or clear has returned. they should only schedule a task
+    def __init__(self):
+        self.heap = []
+        self.timers = {}
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def push(self, timer):
+        # the sequence number keeps timers with the same deadline in order
+        self.sequence += 1
+        heapq.heappush(self.heap, (timer.deadline, self.sequence, timer))
+
+    def add(self, key, delay, callback, interval=None):
+        with self.condition:
+            self.cancel_locked(key)
+            timer = Timer(key, time.monotonic() + delay, callback, interval)
+            self.timers[key] = timer
+            self.push(timer)
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def cancel_locked(self, key):
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancelled = True
+
+    def cancel(self, key):
+        with self.condition:
+            self.cancel_locked(key)
+
+    def clear(self):
+        with self.condition:
+            for timer in self.timers.values():
+                timer.cancelled = True
+            self.timers = {}
+            self.heap = []
+
+    def next_timer(self):
+        # called with the condition held, waits until a timer is due
+        while True:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                self.condition.wait()
+                continue
+            now = time.monotonic()
+            deadline, _, timer = self.heap[0]
+            if deadline <= now:
+                heapq.heappop(self.heap)
+                return timer, now
+            self.condition.wait(deadline - now)
+
+    def run(self):
+        while True:
+            with self.condition:
+                timer, now = self.next_timer()
+                if timer.interval is None:
+                    del self.timers[timer.key]
+                else:
+                    # the next tick is due an interval after this one was due,
+                    # not after it fired, so intervals don't drift. ticks that
+                    # were missed while the thread was late are skipped
+                    timer.deadline += timer.interval
+                    if timer.deadline <= now:
+                        missed = math.floor((now - timer.deadline) / timer.interval) + 1
+                        timer.deadline += missed * timer.interval
+                    self.push(timer)
+                timer.callback()